@@ -0,0 +1,105 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter(object):
+    """
+    Per key (user) rate limit. Every key has a bucket of up to burst tokens, refilled at rate
+    tokens per second; a request takes one token. Only the max_keys most recently seen keys
+    are kept, a key that was evicted starts again with a full bucket. Thread safe.
+    """
+    def __init__(self, rate, burst, max_keys):
+        if (rate <= 0 or burst < 1):
+            # a bucket that never holds a whole token would turn away every request
+            raise ValueError('TokenBucketLimiter needs rate > 0 and burst >= 1')
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.rejected = 0
+        return
+
+    def acquire(self, key):
+        """
+        returns 0 when the request may go on, otherwise the number of seconds until the
+        key has a token again
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if (bucket is None):
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bAdmitted = (tokens >= 1)
+            self._buckets[key] = ((tokens - 1) if bAdmitted else tokens, now)
+            self._buckets.move_to_end(key)
+            while (len(self._buckets) > self.max_keys):
+                self._buckets.popitem(last=False)
+            if (bAdmitted):
+                return 0
+            self.rejected += 1
+        return (1 - tokens) / self.rate
+
+
+class ConcurrencyLimiter(object):
+    """
+    Lets at most max_active requests run at once. Up to max_queued more wait, in arrival
+    order, at most queue_timeout seconds for a slot; anything beyond that is turned away
+    at once. Thread safe.
+    """
+    def __init__(self, max_active, max_queued, queue_timeout):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters = []
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.timed_out = 0
+        return
+
+    def acquire(self):
+        """
+        returns True when the request got a slot, it must then call release() when done
+        """
+        with self._lock:
+            if (self.active < self.max_active and len(self._waiters) == 0):
+                self.active += 1
+                return True
+            if (len(self._waiters) >= self.max_queued):
+                self.rejected += 1
+                return False
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        if (waiter.wait(self.queue_timeout)):
+            return True
+        with self._lock:
+            if (waiter.is_set()):
+                # the slot was handed over just as the wait ran out
+                return True
+            self._waiters.remove(waiter)
+            self.timed_out += 1
+        return False
+
+    def release(self):
+        with self._lock:
+            if (len(self._waiters) > 0):
+                # the slot goes straight to the oldest waiter, active stays the same
+                self._waiters.pop(0).set()
+            else:
+                self.active -= 1
+
+    def get_stats(self):
+        return {'active': self.active, 'queued': len(self._waiters),
+                'rejected': self.rejected, 'timed_out': self.timed_out}
+
+
+def retry_after(seconds):
+    """
+    Retry-After header value, whole seconds and at least 1
+    """
+    return str(max(1, int(math.ceil(seconds))))
@@ -2,11 +2,14 @@
 This script runs the application using a development server.
 It contains the definition of routes and views for the application.
 """
-from flask import Flask, jsonify, abort, make_response
+from flask import Flask, abort
 from flask import url_for
 from flask import request, Response
 from flask_cors import CORS
-import json
+import hmac
+import os
+import jsonCodec
+import metrics
 import validateJWT
 import appSecrets
 import storageBlobService
@@ -18,9 +21,40 @@ CORS(app)
 
 securityObj = securityImpl.securityImpl()
 
+TASK_FIELDS = ('id', 'title', 'description', 'done', 'rev')
+# list responses with at least this many tasks are streamed instead of built in memory
+RESPONSE_STREAM_THRESHOLD = int(os.environ.get('RESPONSE_STREAM_THRESHOLD', 1000))
+# most operations accepted in one batch request, see batch_tasksImpl
+MAX_BATCH_OPERATIONS = int(os.environ.get('MAX_BATCH_OPERATIONS', 1000))
+# /metrics answers only requests with 'Authorization: Bearer <METRICS_SCRAPE_TOKEN>', and 
+# is not there (404) when it is not set
+METRICS_SCRAPE_TOKEN = os.environ.get('METRICS_SCRAPE_TOKEN')
+
 # Make the WSGI interface available at the top level so wfastcgi can get it.
 wsgi_app = app.wsgi_app
 
+def get_wsgi_app():
+    """
+    WSGI entry point of web.config (WSGI_HANDLER app.get_wsgi_app()): wfastcgi calls it 
+    once per worker, it prewarms the worker and returns the WSGI interface
+    """
+    prewarm()
+    return wsgi_app
+
+_prewarmed = False
+
+def prewarm():
+    """
+    Second start-up phase, run once per worker before it takes requests: fetches the token 
+    signing keys and, with PREWARM_STORAGE_KEY=1, the storage key and the task list.
+    Importing this module does no network I/O itself, the entry points call this: 
+    get_wsgi_app, the ASGI lifespan startup of asgiApp and the development server.
+    """
+    global _prewarmed
+    if (not _prewarmed):
+        _prewarmed = True
+        securityObj.prewarm(load_storage_key=(os.environ.get('PREWARM_STORAGE_KEY', '0') == '1'))
+
 @app.errorhandler(401)
 def custom_401(error):
     return Response('Unauthorized', 401, {'Content-Type': 'text/html', 'WWW-Authenticate':'Basic realm="Login Required"'})
@@ -31,7 +65,72 @@ def custom_400(error):
 
 @app.errorhandler(404)
 def not_found(error):
-     return make_response(jsonify({'error': 'Not found'}), 404)
+     return jsonCodec.response({'error': 'Not found'}, 404)
+
+@app.errorhandler(storageBlobService.WriteConflictError)
+def write_conflict(error):
+     return jsonCodec.response({'error': 'Conflict'}, 409)
+
+@app.before_request
+def start_request_timing():
+    # per request stage timings, returned in a Server-Timing header when asked for. The 
+    # spans end when the view returns: serializing a streamed list response (see 
+    # RESPONSE_STREAM_THRESHOLD) happens after that and is not in them
+    if (request.headers.get('X-Request-Timing') == '1'):
+        metrics.start_trace()
+
+@app.after_request
+def end_request_timing(response):
+    timings = metrics.end_trace()
+    if (timings):
+        response.headers['Server-Timing'] = timings
+    return response
+
+@app.teardown_request
+def clear_request_timing(error):
+    # after_request is skipped when the view raised, the thread's next request must not 
+    # inherit the trace
+    metrics.clear_trace()
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if (METRICS_SCRAPE_TOKEN is None):
+        abort(404)
+    authorization = request.headers.get('authorization', '')
+    if (not hmac.compare_digest(authorization.encode('utf-8'), ('Bearer ' + METRICS_SCRAPE_TOKEN).encode('utf-8'))):
+        return Response('Unauthorized', 401, {'Content-Type': 'text/html', 'WWW-Authenticate': 'Bearer'})
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def collectCacheStats():
+    storageStats = securityObj.get_StorageObject().get_cache_stats()
+    tokenCache = securityObj.jwtValidator.verifiedTokens
+    oboStats = securityObj.oboTokenCache.get_stats()
+    return {
+        'storage_hits': storageStats['hits'],
+        'storage_misses': storageStats['misses'],
+        'storage_write_conflicts': storageStats['write_conflicts'],
+        'verified_token_hits': tokenCache.hits,
+        'verified_token_misses': tokenCache.misses,
+        'obo_token_hits': oboStats['hits'],
+        'obo_token_misses': oboStats['misses'],
+        'obo_token_requests': oboStats['external_calls'],
+    }
+
+metrics.register_gauge('taskapi_cache_events', 'Cache hits, misses and external calls since start', 'event', collectCacheStats)
+
+def collectAdmissionStats():
+    stats = {}
+    if (securityObj.rateLimiter is not None):
+        stats['rate_limited'] = securityObj.rateLimiter.rejected
+    if (securityObj.concurrencyLimiter is not None):
+        concurrency = securityObj.concurrencyLimiter.get_stats()
+        stats['active'] = concurrency['active']
+        stats['queued'] = concurrency['queued']
+        stats['queue_full'] = concurrency['rejected']
+        stats['queue_timeout'] = concurrency['timed_out']
+    return stats
+
+metrics.register_gauge('taskapi_admission', 'Requests in progress and waiting, and requests rejected with 429 since start', 'state', collectAdmissionStats)
 
 @app.route('/')
 def hello():
@@ -51,6 +150,10 @@ def get_task(task_id):
 def create_task():
     return coreValidationAndProcessing(request, create_taskImpl)
 
+@app.route('/todo/api/v1.0/tasks/batch', methods=['POST'])
+def batch_tasks():
+    return coreValidationAndProcessing(request, batch_tasksImpl)
+
 @app.route('/todo/api/v1.0/tasks/<int:task_id>', methods=['PUT'])
 def update_task(task_id):
     return coreValidationAndProcessing(request, update_taskImpl, task_id)
@@ -63,11 +166,26 @@ def coreValidationAndProcessing(request, funcInvoke, task_id=None):
     global securityObj
     bRV, re = securityObj.validateRequest(request)
     if (bRV):
-        tasks, storageBlobWrapper = readContentIntoTasks()
-        if (task_id):
-            return funcInvoke(task_id, tasks, storageBlobWrapper,request)
-        else:
-            return funcInvoke(tasks, storageBlobWrapper,request)
+        bStreamed = False
+        try:
+            storageBlobWrapper = securityObj.get_StorageObject()
+            with metrics.span('handler'):
+                if (task_id):
+                    response = funcInvoke(task_id, storageBlobWrapper,request)
+                else:
+                    response = funcInvoke(storageBlobWrapper,request)
+            # a streamed body is generated after we return, the request keeps its slot 
+            # until the server closes the response
+            bStreamed = isinstance(response, Response) and response.is_streamed
+            if (bStreamed):
+                response.call_on_close(securityObj.release)
+            return response
+        finally:
+            if (not bStreamed):
+                securityObj.release()
+    elif (isinstance(re, Response)):
+        # our own responses (401, 429 with Retry-After) go out as they are
+        return re
     else:
         return constructResponseObject(re)
 
@@ -97,56 +215,120 @@ def constructResponseObject(responsePassed):
     return temp_resp
 
 
-def readContentIntoTasks():
-    global securityObj
-    storageBlobWrapper = securityObj.get_StorageObject()
-    content = storageBlobWrapper.get_blob_content()
-    tasks = None
-    if (content and len(content)>0):
-        tasks = json.loads(content)
-    return tasks, storageBlobWrapper
-
-def get_tasksImpl(tasks, storageBlobWrapper, request):
-    return jsonify({'tasks': tasks})
-
-def get_taskImpl(task_id, tasks, storageBlobWrapper, request):
-    if (tasks == None or len(tasks) == 0):
-        abort(404)
-    task = [task for task in tasks if task['id'] == task_id]
-    if len(task) == 0:
+def get_tasksImpl(storageBlobWrapper, request):
+    """
+    Lists the tasks. Optional query parameters: 'limit' and 'offset' for paging, 
+    'done=true|false' to filter and 'fields=id,title,..' to return only those fields.
+    Without any of them the complete list is returned, as before, with "tasks": null 
+    when there are none. 'since=<rev>' returns only what changed after that revision, see 
+    get_changesImpl. In the single blob and log layouts the response has the list revision 
+    ('rev') and an ETag; a request whose If-None-Match has the current ETag gets 304 Not 
+    Modified without a body.
+    """
+    since = parseIntArg(request, 'since', None)
+    etag = None
+    result = {}
+    if (storageBlobWrapper.layout != storageBlobService.LAYOUT_SHARDED):
+        rev, blobEtag = storageBlobWrapper.get_list_version()
+        etag = blobEtag.strip('"')
+        if (request.if_none_match.contains(etag)):
+            notModified = Response(status=304)
+            notModified.set_etag(etag)
+            return notModified
+        result['rev'] = rev
+    elif (since is not None):
+        # the sharded layout keeps no revisions
+        abort(400)
+    if (since is not None):
+        return get_changesImpl(storageBlobWrapper, request, since, etag)
+
+    offset = parseIntArg(request, 'offset', 0)
+    limit = parseIntArg(request, 'limit', None)
+    done = request.args.get('done')
+    if (done is not None):
+        if (done not in ('true', 'false')):
+            abort(400)
+        done = (done == 'true')
+    fields = request.args.get('fields')
+    if (fields is not None):
+        fields = fields.split(',')
+        if (len(fields) == 0 or not set(fields).issubset(TASK_FIELDS)):
+            abort(400)
+
+    tasks, total = storageBlobWrapper.iter_tasks_page(offset, limit, done)
+    if (fields is not None):
+        tasks = ({field: task.get(field) for field in fields} for task in tasks)
+    count = max(0, total - offset)
+    if (limit is not None):
+        count = min(count, limit)
+    if (limit is not None or offset > 0):
+        next_offset = offset + count
+        result['total'] = total
+        result['offset'] = offset
+        result['next_offset'] = next_offset if next_offset < total else None
+
+    if (count >= RESPONSE_STREAM_THRESHOLD):
+        # large lists are serialized task by task into a chunked response
+        response = Response(streamTasksResponse(tasks, result), mimetype='application/json')
+    else:
+        result['tasks'] = list(tasks)
+        if (total == 0 and len(request.args) == 0):
+            result['tasks'] = None
+        response = jsonCodec.response(result)
+    if (etag is not None):
+        response.set_etag(etag)
+    return response
+
+def get_changesImpl(storageBlobWrapper, request, since, etag):
+    """
+    Delta sync: {"rev": .., "tasks": [created or updated after since], "deleted": [ids], 
+    "reset": false}. Clients keep the returned rev for their next poll. With "reset": true 
+    the deletions since that revision are no longer known and "tasks" is the complete list.
+    """
+    if (request.args.get('limit') is not None or request.args.get('offset') is not None or 
+        request.args.get('done') is not None or request.args.get('fields') is not None):
+        abort(400)
+    rev, tasks, deleted, reset = storageBlobWrapper.get_changes(since)
+    response = jsonCodec.response({'rev': rev, 'tasks': tasks, 'deleted': deleted, 'reset': reset})
+    response.set_etag(etag)
+    return response
+
+def streamTasksResponse(tasks, result):
+    yield '{"tasks": '
+    for chunk in storageBlobService.iter_json_array(tasks):
+        yield chunk
+    for key, value in result.items():
+        yield ', {0}: {1}'.format(jsonCodec.dumps(key), jsonCodec.dumps(value))
+    yield '}'
+
+def parseIntArg(request, name, default):
+    value = request.args.get(name)
+    if (value is None):
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400)
+    if (value < 0):
+        abort(400)
+    return value
+
+def get_taskImpl(task_id, storageBlobWrapper, request):
+    task = storageBlobWrapper.get_task(task_id)
+    if (task is None):
         abort(404)
-    return jsonify({'task': task[0]})
+    return jsonCodec.response({'task': task})
 
-def create_taskImpl(tasks, storageBlobWrapper, request):
+def create_taskImpl(storageBlobWrapper, request):
     if not request.json or not 'title' in request.json:
         abort(400)
+    if not validTaskFields(request.json):
+        abort(400)
 
-    if (tasks == None or len(tasks) == 0):
-        tasks = list()
-        task = {
-            'id': 1,
-            'title': request.json['title'],
-            'description': request.json.get('description', ""),
-            'done': False
-        }
-    else:
-        task = {
-            'id': tasks[-1]['id'] + 1,
-            'title': request.json['title'],
-            'description': request.json.get('description', ""),
-            'done': False
-        }
-    tasks.append(task)
-    storageBlobWrapper.update_blob_content(json.dumps(tasks))
-    return jsonify({'task': task}), 201
-
-def update_taskImpl(task_id, tasks, storageBlobWrapper, request):
-    if (tasks == None or len(tasks) == 0):
-        abort(404)
+    task = storageBlobWrapper.create_task(request.json['title'], request.json.get('description', ""))
+    return jsonCodec.response({'task': task}, 201)
 
-    task = [task for task in tasks if task['id'] == task_id]
-    if len(task) == 0:
-        abort(404)
+def update_taskImpl(task_id, storageBlobWrapper, request):
     if not request.json:
         abort(400)
     if 'title' not in request.json :
@@ -155,33 +337,102 @@ def update_taskImpl(task_id, tasks, storageBlobWrapper, request):
         abort(400)
     if 'done' not in request.json:
         abort(400)
+    if not validTaskFields(request.json):
+        abort(400)
 
-    task[0]['title'] = request.json.get('title', task[0]['title'])
-    task[0]['description'] = request.json.get('description', task[0]['description'])
-    task[0]['done'] = request.json.get('done', task[0]['done'])
-    # save it back to storage
-    for idx, item in enumerate(tasks):
-        if (item['id'] == task_id):
-            item['title'] = task[0]['title']
-            item['description'] = task[0]['description']
-            item['done'] = task[0]['done']
-    storageBlobWrapper.update_blob_content(json.dumps(tasks))       
-    return jsonify({'task': task[0]})
-
-def delete_taskImpl(task_id, tasks, storageBlobWrapper, request):
-    if (tasks == None or len(tasks) == 0):
+    task = storageBlobWrapper.update_task(task_id, 
+                                          request.json['title'], 
+                                          request.json['description'], 
+                                          request.json['done'])
+    if (task is None):
         abort(404)
+    return jsonCodec.response({'task': task})
 
-    task = [task for task in tasks if task['id'] == task_id]
-    if len(task) == 0:
+def validTaskFields(fields):
+    # values of the stored task records have the types of the task schema in jsonCodec
+    return (isinstance(fields, dict) and isinstance(fields.get('title', ''), str) and 
+            isinstance(fields.get('description', ''), str) and isinstance(fields.get('done', False), bool))
+
+def delete_taskImpl(task_id, storageBlobWrapper, request):
+    if (not storageBlobWrapper.delete_task(task_id)):
         abort(404)
+    return jsonCodec.response({'result': True})
+
+def batch_tasksImpl(storageBlobWrapper, request):
+    """
+    Applies a list of create/update/delete operations with one read and one write of the 
+    task list: {"operations": [{"op": "create", "title": .., "description": ..}, 
+    {"op": "update", "id": .., "title": .., "description": .., "done": ..}, 
+    {"op": "delete", "id": ..}], "atomic": false}. Returns a status and the task (or 
+    result) per operation: 404 for a task that does not exist, 400 for an operation the 
+    storage layer rejected and, in the sharded layout where each operation is written on 
+    its own, 409 for one that lost to concurrent writers too often. With "atomic": true 
+    either all operations are applied or, when one fails, none; the response is then 409 
+    and the other operations have status 424.
+    """
+    if (not request.json or not isinstance(request.json.get('operations'), list)):
+        abort(400)
+    operations = [parseBatchOperation(operation) for operation in request.json['operations']]
+    if (len(operations) == 0 or len(operations) > MAX_BATCH_OPERATIONS):
+        abort(400)
+    atomic = request.json.get('atomic', False)
+    if (not isinstance(atomic, bool)):
+        abort(400)
+    if (atomic and storageBlobWrapper.layout == storageBlobService.LAYOUT_SHARDED):
+        abort(400)
+
+    outcomes = storageBlobWrapper.apply_batch(operations, atomic)
+    failed = any(error is not None for result, error in outcomes)
+    results = []
+    for operation, (result, error) in zip(operations, outcomes):
+        if (isinstance(error, storageBlobService.TaskNotFoundError)):
+            results.append({'status': 404, 'id': error.task_id})
+        elif (isinstance(error, storageBlobService.WriteConflictError)):
+            results.append({'status': 409, 'error': 'Conflict'})
+        elif (isinstance(error, ValueError)):
+            results.append({'status': 400, 'error': str(error)})
+        elif (error is not None):
+            raise error
+        elif (atomic and failed):
+            results.append({'status': 424})
+        elif (operation['op'] == storageBlobService.OP_DELETE):
+            results.append({'status': 200, 'result': result})
+        elif (operation['op'] == storageBlobService.OP_CREATE):
+            results.append({'status': 201, 'task': result})
+        else:
+            results.append({'status': 200, 'task': result})
+    status = 409 if (atomic and failed) else 200
+    return jsonCodec.response({'results': results, 'applied': not (atomic and failed)}, status)
+
+def parseBatchOperation(operation):
+    if (not isinstance(operation, dict)):
+        abort(400)
+    op = operation.get('op')
+    if (not validTaskFields(operation)):
+        abort(400)
+    if (op == storageBlobService.OP_CREATE):
+        if ('title' not in operation):
+            abort(400)
+        return {'op': op, 'title': operation['title'], 'description': operation.get('description', "")}
+    if (not isinstance(operation.get('id'), int) or isinstance(operation.get('id'), bool)):
+        abort(400)
+    if (op == storageBlobService.OP_UPDATE):
+        if ('title' not in operation or 'description' not in operation or 'done' not in operation):
+            abort(400)
+        return {'op': op, 'id': operation['id'], 'title': operation['title'], 
+                'description': operation['description'], 'done': operation['done']}
+    if (op == storageBlobService.OP_DELETE):
+        return {'op': op, 'id': operation['id']}
+    abort(400)
 
-    tasks.remove(task[0])
-    storageBlobWrapper.update_blob_content(json.dumps(tasks))     
-    return jsonify({'result': True})
+# WSGI hosts that import wsgi_app instead of calling get_wsgi_app can have the worker 
+# prewarmed on import with PREWARM=1
+if (os.environ.get('PREWARM', '0') == '1'):
+    prewarm()
 
 if __name__ == '__main__':
     import os
+    prewarm()
     HOST = os.environ.get('SERVER_HOST', 'localhost')
     try:
         PORT = int(os.environ.get('SERVER_PORT', '5555'))
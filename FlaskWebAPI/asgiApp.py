@@ -0,0 +1,127 @@
+"""
+ASGI serving mode for the task API, e.g. `uvicorn asgiApp:asgi_app --workers 2`.
+It serves the same Flask application, routes and error handlers as the WSGI entry point
+(app.wsgi_app). The storage SDK and the Key Vault client only have blocking APIs, so each
+request runs on a thread pool sized by ASGI_IO_THREADS while the event loop keeps
+accepting and streaming requests; one process overlaps many in-flight blob, token and
+JWKS calls instead of being capped at one request per worker. Response bodies are read on
+a second pool sized by ASGI_BODY_THREADS: requests waiting in the admission queue hold
+their I/O thread, and the admitted requests must still be able to finish their streamed
+bodies and give back their slots.
+"""
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+
+ASGI_IO_THREADS = int(os.environ.get('ASGI_IO_THREADS', 64))
+ASGI_BODY_THREADS = int(os.environ.get('ASGI_BODY_THREADS', 16)) # at most MAX_ACTIVE_REQUESTS bodies stream at once
+
+class TaskApiAsgi(object):
+    """
+    Minimal ASGI to WSGI bridge running the WSGI application on a thread pool. Response
+    bodies are sent chunk by chunk, so streamed task lists stay streamed.
+    """
+    def __init__(self, wsgi_app, io_threads=ASGI_IO_THREADS, body_threads=ASGI_BODY_THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix='taskapi-io')
+        self.body_executor = ThreadPoolExecutor(max_workers=body_threads, thread_name_prefix='taskapi-body')
+        return
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        self.body_executor.shutdown(wait=False)
+
+    async def __call__(self, scope, receive, send):
+        if (scope['type'] == 'lifespan'):
+            await self._lifespan(receive, send)
+        elif (scope['type'] == 'http'):
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope type: ' + scope['type'])
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if (message['type'] == 'lifespan.startup'):
+                # fetches the signing keys (and the storage key) before the first request
+                await asyncio.get_running_loop().run_in_executor(self.executor, app.prewarm)
+                await send({'type': 'lifespan.startup.complete'})
+            elif (message['type'] == 'lifespan.shutdown'):
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = io.BytesIO()
+        while True:
+            message = await receive()
+            if (message['type'] == 'http.disconnect'):
+                return
+            body.write(message.get('body', b''))
+            if (not message.get('more_body')):
+                break
+        body.seek(0)
+
+        started = {}
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self.executor, self.wsgi_app, self._environ(scope, body), start_response)
+        try:
+            chunks = iter(result)
+            response_started = False
+            while True:
+                chunk = await loop.run_in_executor(self.body_executor, next, chunks, None)
+                if (not response_started):
+                    await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+                    response_started = True
+                if (chunk is None):
+                    break
+                if (chunk):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if (hasattr(result, 'close')):
+                # closing a streamed response releases its admission slot
+                await loop.run_in_executor(self.body_executor, result.close)
+
+    def _environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': client[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if (name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH'):
+                key = name
+            else:
+                key = 'HTTP_' + name
+            if (key in environ):
+                value = environ[key] + ',' + value
+            environ[key] = value
+        return environ
+
+# Make the ASGI interface available at the top level, next to app.wsgi_app
+asgi_app = TaskApiAsgi(app.wsgi_app)
@@ -0,0 +1,1002 @@
+"""
+End-to-end benchmark of the task API. Drives every route in app.py through the Flask test
+client, with bearer tokens minted locally and the tasks kept in a local storage backend,
+so it runs without Azure AD, the Key Vault or a storage account. Reports throughput and
+latency percentiles per route for each task count.
+
+    python benchmark.py --tasks 100 1000 10000 --requests 500 --output results.json
+    python benchmark.py --baseline results.json     # exit code 1 on a p95 regression
+    python benchmark.py --tasks 1000 --overload     # one user flooding, see Benchmark.overload
+
+--scenario picks one of the narrower measurements instead of the routes, see the 
+scenario_* methods of Benchmark, e.g.
+
+    python benchmark.py --scenario cache --tasks 1000 10000
+
+Only the network calls are replaced: the signing key is installed in the JWKS cache and
+the on-behalf-of exchange returns a fixed token. Token verification, the claim checks,
+the caches, the storage layer and the JSON handling are the ones used in production.
+Without appSecrets.py the placeholder of the tests is used (see tests/__init__.py), so 
+it runs from a clean checkout.
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import tests        # installs the placeholder appSecrets when there is no appSecrets.py
+
+BENCHMARK_KID = 'benchmark-key'
+BENCHMARK_ISSUER = 'https://sts.benchmark.local/'
+API = '/todo/api/v1.0/tasks'
+BATCH_SIZE = 10            # updates per batch request
+DELTA_CHANGES = 10         # changes returned per delta request
+POLITE_RATE = 5            # requests per second of each well-behaved user in the overload test
+# see the Benchmark.scenario_<name> methods
+SCENARIOS = ('routes', 'cache', 'mutations', 'layouts', 'lookup', 'paging', 'memory', 'codec', 'tokens', 'transport', 'asgi', 'startup', 'metrics')
+STARTUP_HEAVIEST = 8       # top level imports listed by the startup scenario
+CODECS = ('json', 'orjson', 'msgspec')
+MEMORY_RUNS = 3            # traced runs per operation in the memory scenario, the highest peak counts
+UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024     # what the storage SDK reads from a stream per block
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Task API benchmark')
+    parser.add_argument('--scenario', choices=SCENARIOS, default='routes',
+                        help='what to measure, the routes of app.py by default')
+    parser.add_argument('--tasks', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='task counts to seed the storage with, one run each')
+    parser.add_argument('--requests', type=int, default=300, help='requests per route and run')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed requests per route and run')
+    parser.add_argument('--users', type=int, default=10, help='distinct users (bearer tokens)')
+    parser.add_argument('--backend', choices=['memory', 'local'], default='memory')
+    parser.add_argument('--layout', choices=['single', 'sharded', 'log'], default='single')
+    parser.add_argument('--mmap', action='store_true', help='local backend reads through mmap')
+    parser.add_argument('--overload', action='store_true',
+                        help='also measure the well-behaved users while one user floods the API')
+    parser.add_argument('--flood-threads', type=int, default=4, help='threads of the flooding user')
+    parser.add_argument('--overload-seconds', type=float, default=5, help='duration of each overload phase')
+    parser.add_argument('--concurrency', type=int, default=16, help='client threads of the asgi scenario')
+    parser.add_argument('--io-latency', type=float, default=5,
+                        help='milliseconds added to every blob call in the asgi scenario')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed p95 increase over the baseline, 0.25 = 25%%')
+    return parser.parse_args(argv)
+
+
+class Benchmark(object):
+    """
+    Holds the app, the signing key and the user tokens shared by all the runs
+    """
+    def __init__(self, args):
+        self.args = args
+        # directories of the local backend, removed by cleanup()
+        self.temp_dirs = []
+        # the app reads these when it is imported. The storage object it makes then must 
+        # not create its directory in the current one
+        os.environ['PREWARM'] = '0'
+        os.environ['STORAGE_BACKEND'] = args.backend
+        os.environ['STORAGE_LAYOUT'] = args.layout
+        os.environ['STORAGE_LOCAL_MMAP'] = '1' if args.mmap else '0'
+        os.environ['STORAGE_LOCAL_PATH'] = self.temp_dir()
+        started = time.perf_counter()
+        import app
+        self.import_seconds = time.perf_counter() - started
+        import appSecrets
+        self.app = app
+        self.client = app.app.test_client()
+
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        self.signing_key = signing_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        jwks = app.securityObj.jwtValidator.jwks
+        jwks.issuer = BENCHMARK_ISSUER
+        jwks._keys = {BENCHMARK_KID: signing_key.public_key()}
+        jwks._last_fetch = time.time()
+        jwks._fetch = lambda: None      # prewarm and refreshes keep the key above
+        app.securityObj.exchangeUserCredentials = lambda bearerToken: ({'access_token': 'benchmark',
+                                                                        'token_type': 'Bearer',
+                                                                        'expires_in': 3600}, None)
+        self.headers = [{'Authorization': 'Bearer ' + self.mint_token(signing_key, appSecrets.ClientId, user)}
+                        for user in range(args.users)]
+        # the route runs measure the routes, the admission limits only apply in overload()
+        self.limiters = (app.securityObj.rateLimiter, app.securityObj.concurrencyLimiter)
+        app.securityObj.rateLimiter = app.securityObj.concurrencyLimiter = None
+        return
+
+    def mint_token(self, signing_key, audience, user):
+        import jwt
+        now = int(time.time())
+        claims = {
+            'aud': audience,
+            'iss': BENCHMARK_ISSUER,
+            'iat': now,
+            'nbf': now,
+            'exp': now + 3600,
+            'oid': 'benchmark-user-{0}'.format(user),
+            'scp': 'user_impersonation',
+        }
+        return jwt.encode(claims, signing_key, algorithm='RS256', headers={'kid': BENCHMARK_KID})
+
+    def new_storage(self, task_count):
+        """
+        Fresh storage seeded with task_count tasks, installed as the app's storage object
+        """
+        storage = self.open_storage(self.seed_service(task_count))
+        # the sharded and log layouts migrate the seeded list on first use
+        storage.prewarm()
+        self.app.securityObj.storageObject = storage
+        return storage
+
+    def seed_service(self, task_count):
+        """
+        Fresh blob service of the --backend kind holding task_count tasks in the single blob layout
+        """
+        import storageBlobService
+        if (self.args.backend == 'local'):
+            os.environ['STORAGE_LOCAL_PATH'] = self.temp_dir()
+        seed = storageBlobService.StorageBlobServiceWrapper('benchmark', layout=storageBlobService.LAYOUT_SINGLE)
+        seed.update_blob_tasks(make_tasks(task_count))
+        return seed.service
+
+    def temp_dir(self):
+        directory = tempfile.mkdtemp(prefix='taskapi-benchmark-')
+        self.temp_dirs.append(directory)
+        return directory
+
+    def cleanup(self):
+        while (self.temp_dirs):
+            shutil.rmtree(self.temp_dirs.pop(), ignore_errors=True)
+
+    def open_storage(self, service, layout=None, **kwargs):
+        import storageBlobService
+        storage = storageBlobService.StorageBlobServiceWrapper('benchmark', layout=layout or self.args.layout, **kwargs)
+        storage.service = storage.append_service = service
+        return storage
+
+    def measure(self, operation, service=None, count=None):
+        """
+        Runs operation(i) --warmup times untimed, then count (--requests) times timed. The 
+        result has the CPU time per operation next to the latencies. With service, a 
+        CountingBlobService, it also has the blob calls per timed operation.
+        """
+        count = count or self.args.requests
+        for i in range(min(self.args.warmup, count)):
+            operation(i)
+        if (service is not None):
+            service.calls.clear()
+        latencies = []
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        for i in range(count):
+            start = time.perf_counter()
+            operation(i)
+            latencies.append(time.perf_counter() - start)
+        result = summarize(latencies, time.perf_counter() - started, 0)
+        result['cpu_ms'] = (time.process_time() - cpu_started) * 1000 / count
+        if (service is not None):
+            result['blob_calls'] = {name: calls / float(count) for name, calls in sorted(service.calls.items())}
+        return result
+
+    def scenario_cache(self, task_count):
+        """
+        Reads of one task through the cache of the parsed task list: 'cached' within the TTL, 
+        'revalidated' with a TTL of 0 (an ETag check per read) and 'uncached' with the cache 
+        dropped before every read, so the list is downloaded and parsed every time, as every 
+        request did before the cache. Single blob layout.
+        """
+        import storageBlobService
+        service = CountingBlobService(self.seed_service(task_count))
+        results = {}
+        for name, ttl, drop in (('cached', 3600, False), ('revalidated', 0, False), ('uncached', 0, True)):
+            storage = self.open_storage(service, layout=storageBlobService.LAYOUT_SINGLE, cache_ttl_seconds=ttl)
+            storage.prewarm()
+            def read(i):
+                if (drop):
+                    storage.invalidate_cache()
+                storage.get_task(random.randint(1, task_count))
+            results[name] = self.measure(read, service)
+            results[name]['cache'] = storage.get_cache_stats()
+        return results
+
+    def cold_load(self, storage):
+        """
+        Time a process starting on the current data takes to load the task list
+        """
+        latencies = []
+        started = time.perf_counter()
+        for i in range(max(1, self.args.requests // 50)):
+            start = time.perf_counter()
+            self.open_storage(storage.service).prewarm()
+            latencies.append(time.perf_counter() - start)
+        return summarize(latencies, time.perf_counter() - started, 0)
+
+    def scenario_mutations(self, task_count):
+        """
+        Latency and blob calls of each kind of mutation, made through the storage wrapper in 
+        the --layout layout, and of update_blob_content (the raw upload of the single blob). 
+        No write downloads what it has just uploaded.
+        """
+        service = CountingBlobService(self.seed_service(task_count))
+        storage = self.open_storage(service)
+        storage.prewarm()
+        created = []
+        def create(i):
+            created.append(storage.create_task('New task {0}'.format(i), 'created by the benchmark')['id'])
+        def update(i):
+            storage.update_task(created[i % len(created)], 'Updated {0}'.format(i), 'updated', True)
+        def delete(i):
+            storage.delete_task(created.pop())
+        results = {}
+        for name, operation in (('create', create), ('update', update), ('delete', delete)):
+            results[name] = self.measure(operation, service)
+        if (storage.layout == 'single'):
+            content = service.get_blob_to_text(storage.container_name, storage.blob_name).content
+            results['upload'] = self.measure(lambda i: storage.update_blob_content(content), service)
+        return results
+
+    def scenario_layouts(self, task_count):
+        """
+        The storage operations behind each route in every layout, each from a fresh copy of 
+        the same seeded list, with their blob calls. Listing reads every task blob in the 
+        sharded layout, so it is timed --requests/10 times only.
+        Meant for --tasks 1000 10000 100000.
+        """
+        results = {}
+        for layout in ('single', 'sharded', 'log'):
+            service = CountingBlobService(self.seed_service(task_count))
+            storage = self.open_storage(service, layout=layout)
+            storage.prewarm()
+            created = []
+            def create(i):
+                created.append(storage.create_task('New task {0}'.format(i), 'created by the benchmark')['id'])
+            operations = (
+                ('list', lambda i: list(storage.iter_tasks_page()[0]), max(3, self.args.requests // 10)),
+                ('page', lambda i: storage.get_tasks_page(random.randint(0, max(task_count - 50, 0)), 50), None),
+                ('get', lambda i: storage.get_task(random.randint(1, task_count)), None),
+                ('create', create, None),
+                ('update', lambda i: storage.update_task(created[i % len(created)], 'Updated', 'updated', True), None),
+                ('delete', lambda i: storage.delete_task(created.pop()), None),
+            )
+            for name, operation, count in operations:
+                results['{0} {1}'.format(layout, name)] = self.measure(operation, service, count)
+        return results
+
+    def scenario_lookup(self, task_count):
+        """
+        CPU per lookup, update and delete of one task in the id keyed TaskTable the handlers 
+        share ('table'), against the linear scans of the task list the handlers used to make 
+        ('scan'): one per lookup, two per update and three per delete. A table update or 
+        delete goes through next_version, which keeps only the change; the copy the single 
+        blob layout then makes for its upload is not included.
+        """
+        import storageBlobService
+        tasks = make_tasks(task_count)
+        table = storageBlobService.TaskTable((task['id'], task) for task in tasks)
+        ids = [random.randint(1, task_count) for i in range(max(self.args.warmup, self.args.requests))]
+        def scan_get(i):
+            return [task for task in tasks if task['id'] == ids[i]][0]
+        def scan_update(i):
+            task = [task for task in tasks if task['id'] == ids[i]][0]
+            for idx, item in enumerate(tasks):
+                if (item['id'] == ids[i]):
+                    item['title'] = task['title']
+        def scan_delete(i):
+            task = [task for task in tasks if task['id'] == ids[i]][0]
+            tasks.remove(task)
+            tasks.append(task)      # put back, so every run sees the same number of tasks
+        def table_update(i):
+            version = table.next_version()
+            version.put(dict(version[ids[i]], title='Updated'))
+        def table_delete(i):
+            table.next_version().remove(ids[i])
+        operations = (
+            ('scan get', scan_get),
+            ('table get', lambda i: table.get(ids[i])),
+            ('scan update', scan_update),
+            ('table update', table_update),
+            ('scan delete', scan_delete),
+            ('table delete', table_delete),
+        )
+        return {name: self.measure(operation) for name, operation in operations}
+
+    def scenario_paging(self, task_count):
+        """
+        Latency and response size of GET /tasks for the whole list, as every client got it 
+        before paging, against a page of 50 tasks, a page of 50 done tasks and a page of 50 
+        with two fields only
+        """
+        self.new_storage(task_count)
+        page_offsets = list(range(0, max(task_count - 50, 0) + 1, 50))
+        paths = (
+            ('full list', API),
+            ('page', API + '?limit=50&offset={0}'),
+            ('done page', API + '?done=true&limit=50&offset={1}'),
+            ('fields page', API + '?fields=id,title&limit=50&offset={0}'),
+        )
+        results = {}
+        for name, path in paths:
+            sizes = []
+            def get(i):
+                offset = random.choice(page_offsets)
+                response = self.request('get', path.format(offset, offset // 3), None, i)
+                if (response.status_code != 200):
+                    raise RuntimeError('{0} returned {1}'.format(name, response.status_code))
+                sizes.append(len(response.get_data()))
+            results[name] = self.measure(get)
+            results[name]['response_bytes'] = sum(sizes) // len(sizes)
+        return results
+
+    def scenario_memory(self, task_count):
+        """
+        Peak memory allocated (tracemalloc) by one GET /tasks of the whole list and by one 
+        upload of the task list blob, each buffered in full against streamed. The response 
+        body is read chunk by chunk and dropped, and the uploads go to a DiscardingBlobService, 
+        so only what the app itself holds is counted. Latencies are from untraced runs.
+        """
+        import storageBlobService
+        storage = self.new_storage(task_count)
+        table = storageBlobService.TaskTable((task['id'], task) for task in make_tasks(task_count))
+        uploader = self.open_storage(DiscardingBlobService(), layout=storageBlobService.LAYOUT_SINGLE)
+        response_threshold = self.app.RESPONSE_STREAM_THRESHOLD
+        def get_list(i):
+            response = self.client.get(API, headers=self.headers[i % len(self.headers)], buffered=False)
+            for chunk in response.response:
+                pass
+            response.close()
+        def upload(i):
+            uploader._upload_task_document(uploader.blob_name, table)
+        operations = (
+            ('list buffered', get_list, lambda: setattr(self.app, 'RESPONSE_STREAM_THRESHOLD', sys.maxsize)),
+            ('list streamed', get_list, lambda: setattr(self.app, 'RESPONSE_STREAM_THRESHOLD', 0)),
+            ('upload buffered', upload, lambda: setattr(uploader, 'stream_threshold', sys.maxsize)),
+            ('upload streamed', upload, lambda: setattr(uploader, 'stream_threshold', 0)),
+        )
+        results = {}
+        try:
+            for name, operation, configure in operations:
+                configure()
+                results[name] = self.measure(operation)
+                results[name]['peak_kb'] = trace_peak(operation) // 1024
+        finally:
+            self.app.RESPONSE_STREAM_THRESHOLD = response_threshold
+        return results
+
+    def scenario_codec(self, task_count):
+        """
+        Encoding of a list response and decoding of the task list blob, with each JSON 
+        backend of jsonCodec that is installed, on the same tasks. Reports the MB of JSON 
+        per second next to the latencies.
+        """
+        import jsonCodec
+        import storageBlobService
+        tasks = make_tasks(task_count)
+        table = storageBlobService.TaskTable((task['id'], task) for task in tasks)
+        document = ''.join(storageBlobService.iter_task_document(table))
+        backend = (jsonCodec._orjson, jsonCodec._msgspec, jsonCodec._TaskBlob)
+        results = {}
+        try:
+            for codec in CODECS:
+                jsonCodec._orjson = jsonCodec._msgspec = jsonCodec._TaskBlob = None
+                if (jsonCodec._load_backend(codec) != codec):
+                    print('{0} is not installed, skipped'.format(codec))
+                    continue
+                encoded = len(jsonCodec.dumps_bytes({'tasks': tasks}))
+                for name, operation, size in (
+                        ('encode', lambda i: jsonCodec.dumps_bytes({'tasks': tasks}), encoded),
+                        ('decode', lambda i: jsonCodec.decode_task_blob(document), len(document))):
+                    result = self.measure(operation)
+                    result['mb_per_s'] = round(size * result['throughput'] / 1e6, 1)
+                    results['{0} {1}'.format(codec, name)] = result
+        finally:
+            jsonCodec._orjson, jsonCodec._msgspec, jsonCodec._TaskBlob = backend
+        return results
+
+    def scenario_tokens(self, task_count):
+        """
+        Bearer token validations per second: the same --users tokens again and again, 
+        answered from the verified token cache ('cached'), against a token never seen 
+        before on every validation, verified in full ('uncached'), with the cache hit rate 
+        of each. The tokens are signed with the local RSA key. The task count is not used.
+        """
+        import appSecrets
+        validator = self.app.securityObj.jwtValidator
+        tokens = [header['Authorization'].split('Bearer ')[1] for header in self.headers]
+        count = max(self.args.warmup, self.args.requests)
+        fresh_tokens = [self.mint_token(self.signing_key, appSecrets.ClientId, 'fresh-{0}'.format(i)) for i in range(2 * count)]
+        def validate(token):
+            bRV, decoded = validator.validate_jwt(token)
+            if (not bRV):
+                raise RuntimeError('token not valid')
+        results = {}
+        for name, operation in (('cached', lambda i: validate(tokens[i % len(tokens)])), 
+                                ('uncached', lambda i: validate(fresh_tokens.pop()))):
+            validator.verifiedTokens.hits = validator.verifiedTokens.misses = 0
+            results[name] = self.measure(operation)
+            results[name]['hit_rate'] = round(validator.verifiedTokens.hit_rate(), 3)
+        return results
+
+    def scenario_transport(self, task_count):
+        """
+        Latency of a small GET and of a token style POST against a local HTTPS stub, through 
+        the pooled keep-alive session of httpTransport, against a new connection (TCP and 
+        TLS handshake) for every call, which is what the module level requests calls did. 
+        The task count is not used.
+        """
+        import httpTransport
+        import requests
+        with tempfile.TemporaryDirectory(prefix='taskapi-benchmark-') as directory:
+            server, url, certfile = start_https_stub(directory)
+            try:
+                def new_connection(method):
+                    def call(i):
+                        with requests.Session() as session:
+                            check_status(getattr(session, method)(url, verify=certfile, data=TOKEN_FORM if (method == 'post') else None))
+                    return call
+                operations = (
+                    ('get pooled', lambda i: check_status(httpTransport.get(url, verify=certfile))),
+                    ('get new conn', new_connection('get')),
+                    ('post pooled', lambda i: check_status(httpTransport.post(url, verify=certfile, data=TOKEN_FORM))),
+                    ('post new conn', new_connection('post')),
+                )
+                return {name: self.measure(operation) for name, operation in operations}
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def scenario_asgi(self, task_count):
+        """
+        Requests per second and latency over real HTTP connections, --concurrency clients 
+        paging through the list and reading single tasks, served by:
+        - 'wsgi': app.wsgi_app one request at a time, like a wfastcgi worker process
+        - 'wsgi threaded': app.wsgi_app on a thread per request (werkzeug)
+        - 'asgi': asgiApp.asgi_app in uvicorn
+        All in this one process. Every blob call takes --io-latency ms longer (DelayedBlobService) 
+        and the storage cache is revalidated on every read, standing in for the storage account.
+        """
+        import asgiApp
+        import logging
+        import uvicorn
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)     # no line per request
+        storage = self.new_storage(task_count)
+        storage.service = storage.append_service = DelayedBlobService(storage.service, self.args.io_latency / 1000.0)
+        storage.cache_ttl_seconds = 0
+        results = {}
+        for name in ('wsgi', 'wsgi threaded', 'asgi'):
+            if (name == 'asgi'):
+                port = free_port()
+                server = uvicorn.Server(uvicorn.Config(asgiApp.asgi_app, host='127.0.0.1', port=port, 
+                                                       lifespan='off', log_level='warning'))
+                thread = threading.Thread(target=server.run, daemon=True)
+                thread.start()
+                while (not server.started):
+                    time.sleep(0.01)
+                stop = lambda: setattr(server, 'should_exit', True)
+            else:
+                server = make_server('127.0.0.1', 0, self.app.wsgi_app, threaded=(name == 'wsgi threaded'))
+                port = server.server_port
+                thread = threading.Thread(target=server.serve_forever, daemon=True)
+                thread.start()
+                stop = server.shutdown
+            try:
+                results[name] = self.http_load('http://127.0.0.1:{0}'.format(port), task_count)
+            finally:
+                stop()
+                thread.join()
+        return results
+
+    def http_load(self, url, task_count):
+        """
+        --requests requests (after --warmup untimed ones) from --concurrency threads, each 
+        with its own keep-alive connection
+        """
+        import requests
+        latencies = []
+        errors = [0]
+        remaining = [self.args.warmup + self.args.requests]
+        lock = threading.Lock()
+        def client(number):
+            rng = random.Random(number)
+            with requests.Session() as session:
+                while True:
+                    with lock:
+                        if (remaining[0] == 0):
+                            return
+                        remaining[0] -= 1
+                        timed = remaining[0] < self.args.requests
+                    if (rng.random() < 0.8):
+                        path = API + '?limit=50&offset={0}'.format(rng.randint(0, max(task_count - 50, 0)))
+                    else:
+                        path = API + '/{0}'.format(rng.randint(1, max(task_count, 1)))
+                    start = time.perf_counter()
+                    response = session.get(url + path, headers=self.headers[number % len(self.headers)])
+                    if (timed):
+                        latencies.append(time.perf_counter() - start)
+                        if (response.status_code != 200):
+                            errors[0] += 1
+        threads = [threading.Thread(target=client, args=(number,)) for number in range(self.args.concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return summarize(latencies, time.perf_counter() - started, errors[0])
+
+    def scenario_startup(self, task_count):
+        """
+        Cold start of a worker, each measured in a new Python process: 'import app' is the 
+        import time of app.py with the heaviest top level imports (python -X importtime, 
+        cumulative ms); 'cold' and 'prewarmed' are the first and second GET /tasks of a 
+        worker that was not prewarmed and of one that ran app.prewarm() first.
+        """
+        import subprocess
+        here = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ, PREWARM='0', STORAGE_BACKEND='memory')
+        # tests is imported first for the placeholder appSecrets, it does not count for app
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import tests, app'], cwd=here, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        # a module is listed after the modules it imports, indented two more spaces than them
+        imports = {}
+        for line in completed.stderr.splitlines():
+            fields = line.split('|')
+            if (len(fields) != 3 or not fields[1].strip().isdigit()):
+                continue
+            name = fields[2].strip()
+            depth = (len(fields[2]) - len(fields[2].lstrip()) - 1) // 2
+            if (depth == 0):
+                if (name == 'app'):
+                    import_ms = int(fields[1]) / 1000.0
+                    break
+                imports = {}
+            elif (depth == 1):
+                imports[name] = int(fields[1]) / 1000.0
+        heaviest = sorted(imports, key=imports.get, reverse=True)[:STARTUP_HEAVIEST]
+        results = {'import app': {'import_ms': import_ms, 'heaviest': {name: imports[name] for name in heaviest}}}
+        for name in ('cold', 'prewarmed'):
+            argv = ['--backend', self.args.backend, '--layout', self.args.layout, '--tasks', str(task_count)]
+            if (name == 'prewarmed'):
+                argv.append('--prewarm')
+            completed = subprocess.run([sys.executable, '-c', 'import benchmark, sys; benchmark.measure_startup(sys.argv[1:])'] + argv,
+                                       cwd=here, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+            results[name] = json.loads(completed.stdout.splitlines()[-1])
+        return results
+
+    def scenario_metrics(self, task_count):
+        """
+        Overhead of the request instrumentation of metrics.py on three routes: 'off' with 
+        metrics.span replaced by a no-op, 'on' as deployed, 'traced' also with the 
+        X-Request-Timing header (Server-Timing response). The modes take turns request by 
+        request, so drift of the machine affects them alike. overhead_pct is the p50 
+        increase over 'off'.
+        """
+        import metrics
+        self.new_storage(task_count)
+        count = self.args.requests
+        ids = [random.randint(1, task_count) for i in range(self.args.warmup + count)]
+        routes = (
+            ('get', lambda i, headers: self.client.get(API + '/{0}'.format(ids[i]), headers=headers)),
+            ('page', lambda i, headers: self.client.get(API + '?limit=50', headers=headers)),
+            ('update', lambda i, headers: self.client.put(API + '/{0}'.format(ids[i]), headers=headers, 
+                                                          json={'title': 'Updated', 'description': '', 'done': True})),
+        )
+        modes = (('off', NoSpan, {}), ('on', metrics.span, {}), ('traced', metrics.span, {'X-Request-Timing': '1'}))
+        span = metrics.span
+        results = {}
+        try:
+            for route, call in routes:
+                latencies = {mode: [] for mode, stage_span, extra_headers in modes}
+                started = time.perf_counter()
+                for i in range(self.args.warmup + count):
+                    # and each goes first in turn
+                    for mode, stage_span, extra_headers in modes[i % len(modes):] + modes[:i % len(modes)]:
+                        metrics.span = stage_span
+                        headers = dict(self.headers[i % len(self.headers)], **extra_headers)
+                        start = time.perf_counter()
+                        check_status(call(i, headers))
+                        if (i >= self.args.warmup):
+                            latencies[mode].append(time.perf_counter() - start)
+                elapsed = (time.perf_counter() - started) / len(modes)
+                for mode, stage_span, extra_headers in modes:
+                    results['{0} {1}'.format(route, mode)] = summarize(latencies[mode], elapsed, 0)
+                for mode in ('on', 'traced'):
+                    result = results['{0} {1}'.format(route, mode)]
+                    result['overhead_pct'] = round((result['p50_ms'] / results[route + ' off']['p50_ms'] - 1) * 100, 1)
+        finally:
+            metrics.span = span
+        return results
+
+    def scenario_routes(self, task_count):
+        storage = self.new_storage(task_count)
+        created = []    # ids of the tasks created by the benchmark
+        ids = list(range(1, task_count + 1))
+        page_offsets = list(range(0, max(task_count - 50, 0) + 1, 50))
+        routes = [
+            ('list', 'get', lambda i: API, None, 200),
+            ('page', 'get', lambda i: '{0}?limit=50&offset={1}'.format(API, random.choice(page_offsets)), None, 200),
+            ('get', 'get', lambda i: '{0}/{1}'.format(API, random.choice(ids)), None, 200),
+            ('create', 'post', lambda i: API,
+             lambda i: {'title': 'New task {0}'.format(i), 'description': 'created by the benchmark'}, 201),
+            # update and delete work on the tasks created above, so the task count stays the same
+            ('update', 'put', lambda i: '{0}/{1}'.format(API, created[i % len(created)]),
+             lambda i: {'title': 'Updated {0}'.format(i), 'description': 'updated', 'done': True}, 200),
+            ('batch', 'post', lambda i: API + '/batch',
+             lambda i: {'operations': [{'op': 'update', 'id': created[(i + j) % len(created)], 'title': 'Batch {0}'.format(i),
+                                        'description': 'updated in a batch', 'done': False} for j in range(BATCH_SIZE)]}, 200),
+            ('delete', 'delete', lambda i: '{0}/{1}'.format(API, created.pop()), None, 200),
+        ]
+        if (self.args.layout in ('single', 'log')):
+            # a client that is DELTA_CHANGES changes behind
+            routes.append(('delta', 'get', lambda i: '{0}?since={1}'.format(API, max(0, storage.get_list_version()[0] - DELTA_CHANGES)),
+                           None, 200))
+        results = {}
+        for name, method, path, body, expected_status in routes:
+            for i in range(self.args.warmup):
+                response = self.request(method, path(i), body and body(i), i)
+                if (name == 'create' and response.status_code == expected_status):
+                    created.append(response.get_json()['task']['id'])
+            latencies = []
+            errors = 0
+            started = time.perf_counter()
+            for i in range(self.args.requests):
+                request_path = path(i)
+                request_body = body and body(i)
+                start = time.perf_counter()
+                response = self.request(method, request_path, request_body, i)
+                latencies.append(time.perf_counter() - start)
+                if (response.status_code != expected_status):
+                    errors += 1
+                elif (name == 'create'):
+                    created.append(response.get_json()['task']['id'])
+            elapsed = time.perf_counter() - started
+            results[name] = summarize(latencies, elapsed, errors)
+        # after the writes above, so the log layout has a log to replay
+        results['cold'] = self.cold_load(storage)
+        if (self.args.overload):
+            results.update(self.overload())
+        return results
+
+    def overload(self):
+        """
+        Latency of the well-behaved users (each paging at POLITE_RATE requests per second), 
+        alone and while user 0 requests the complete list from --flood-threads threads as 
+        fast as it can, with the admission limits of securityImpl in place. 'flood' counts 
+        the 429 responses of user 0 as rejected, anything but 200 and 429 as errors.
+        """
+        security = self.app.securityObj
+        security.rateLimiter, security.concurrencyLimiter = self.limiters
+        try:
+            results = {'polite': self.polite_load()}
+            stop = threading.Event()
+            flood = {'latencies': [], 'rejected': 0, 'errors': 0}
+            def flooder():
+                client = self.app.app.test_client()
+                while (not stop.is_set()):
+                    start = time.perf_counter()
+                    response = client.get(API, headers=self.headers[0])
+                    response.get_data()
+                    response.close()    # gives back the concurrency slot of a streamed response
+                    flood['latencies'].append(time.perf_counter() - start)
+                    if (response.status_code == 429):
+                        flood['rejected'] += 1
+                    elif (response.status_code != 200):
+                        flood['errors'] += 1
+            threads = [threading.Thread(target=flooder) for i in range(self.args.flood_threads)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            results['polite_flood'] = self.polite_load()
+            stop.set()
+            for thread in threads:
+                thread.join()
+            results['flood'] = summarize(flood['latencies'], time.perf_counter() - started, flood['errors'])
+            results['flood']['rejected'] = flood['rejected']
+        finally:
+            security.rateLimiter = security.concurrencyLimiter = None
+        return results
+
+    def polite_load(self):
+        latencies = []
+        errors = [0]
+        def user(headers):
+            client = self.app.app.test_client()
+            deadline = time.perf_counter() + self.args.overload_seconds
+            next_request = time.perf_counter()
+            while (next_request < deadline):
+                time.sleep(max(0, next_request - time.perf_counter()))
+                next_request += 1.0 / POLITE_RATE
+                start = time.perf_counter()
+                response = client.get(API + '?limit=50', headers=headers)
+                response.get_data()
+                response.close()
+                latencies.append(time.perf_counter() - start)
+                if (response.status_code != 200):
+                    errors[0] += 1
+        threads = [threading.Thread(target=user, args=(headers,)) for headers in self.headers[1:]]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return summarize(latencies, time.perf_counter() - started, errors[0])
+
+    def request(self, method, path, body=None, i=0):
+        headers = self.headers[i % len(self.headers)]
+        response = getattr(self.client, method)(path, headers=headers, json=body)
+        response.get_data()     # drains streamed responses
+        response.close()        # and releases their admission slot
+        return response
+
+
+class CountingBlobService(object):
+    """
+    Wraps a blob service and counts the calls made to it, by method name
+    """
+    def __init__(self, service):
+        self.service = service
+        self.calls = collections.Counter()
+        return
+
+    def __getattr__(self, name):
+        attribute = getattr(self.service, name)
+        if (not callable(attribute)):
+            return attribute
+        def call(*args, **kwargs):
+            self.calls[name] += 1
+            return attribute(*args, **kwargs)
+        return call
+
+
+class DiscardingBlobService(object):
+    """
+    Upload target that drops what it is sent, reading streams a block at a time like the SDK
+    """
+    def create_blob_from_text(self, container_name, blob_name, text, **kwargs):
+        return UploadedBlobProperties()
+
+    def create_blob_from_stream(self, container_name, blob_name, stream, **kwargs):
+        while (stream.read(UPLOAD_BLOCK_SIZE)):
+            pass
+        return UploadedBlobProperties()
+
+
+class UploadedBlobProperties(object):
+    etag = '"discarded"'
+
+
+def trace_peak(operation):
+    """
+    highest memory allocated while operation runs, over MEMORY_RUNS runs, in bytes
+    """
+    peak = 0
+    tracemalloc.start()
+    try:
+        for i in range(MEMORY_RUNS):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            operation(i)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+class DelayedBlobService(object):
+    """
+    Wraps a blob service and makes every call take delay seconds longer, like a remote one
+    """
+    def __init__(self, service, delay):
+        self.service = service
+        self.delay = delay
+        return
+
+    def __getattr__(self, name):
+        attribute = getattr(self.service, name)
+        if (not callable(attribute)):
+            return attribute
+        def call(*args, **kwargs):
+            time.sleep(self.delay)
+            return attribute(*args, **kwargs)
+        return call
+
+
+class NoSpan(object):
+    """
+    metrics.span that records nothing, the baseline of scenario_metrics
+    """
+    def __init__(self, stage):
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+TOKEN_FORM = {'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer', 'requested_token_use': 'on_behalf_of',
+              'assertion': 'x' * 1200}
+STUB_RESPONSE = b'{"token_type": "Bearer", "expires_in": 3600, "access_token": "benchmark"}'
+
+def start_https_stub(directory):
+    """
+    HTTPS server on localhost answering every GET and POST with a small JSON document, with a 
+    self-signed certificate written to directory. Returns the server, its URL and the 
+    certificate file to verify it with.
+    """
+    import datetime
+    import ipaddress
+    import ssl
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+                   .public_key(key.public_key()).serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(minutes=5)).not_valid_after(now + datetime.timedelta(days=1))
+                   .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]), critical=False)
+                   .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+                   .sign(key, hashes.SHA256()))
+    certfile = os.path.join(directory, 'stub.pem')
+    keyfile = os.path.join(directory, 'stub.key')
+    with open(certfile, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'       # keep-alive
+        disable_nagle_algorithm = True      # headers and body go out as separate writes
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(STUB_RESPONSE)))
+            self.end_headers()
+            self.wfile.write(STUB_RESPONSE)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.do_GET()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'https://127.0.0.1:{0}/token'.format(server.server_port), certfile
+
+def check_status(response):
+    if (response.status_code != 200):
+        raise RuntimeError('stub returned {0}'.format(response.status_code))
+    return response
+
+def measure_startup(argv):
+    """
+    Run by scenario_startup in a process of its own: prints the import time of app, the 
+    prewarm time with --prewarm and the first and second GET /tasks, as JSON
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prewarm', action='store_true')
+    argv, rest = parser.parse_known_args(argv)
+    benchmark = Benchmark(parse_args(rest))
+    try:
+        result = {'import_ms': benchmark.import_seconds * 1000}
+        # seeded but, unlike new_storage, not prewarmed
+        benchmark.app.securityObj.storageObject = benchmark.open_storage(benchmark.seed_service(benchmark.args.tasks[0]))
+        if (argv.prewarm):
+            started = time.perf_counter()
+            benchmark.app.prewarm()
+            result['prewarm_ms'] = (time.perf_counter() - started) * 1000
+        for name in ('first_request_ms', 'second_request_ms'):
+            started = time.perf_counter()
+            check_status(benchmark.request('get', API))
+            result[name] = (time.perf_counter() - started) * 1000
+    finally:
+        benchmark.cleanup()
+    print(json.dumps(result))
+
+def make_tasks(task_count):
+    return [{'id': task_id, 'title': 'Task {0}'.format(task_id),
+             'description': 'Benchmark task number {0}'.format(task_id), 'done': task_id % 3 == 0}
+            for task_id in range(1, task_count + 1)]
+
+LATENCY_KEYS = ('requests', 'errors', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+
+def summarize(latencies, elapsed, errors):
+    latencies = sorted(latencies)
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p / 100.0 * len(latencies)))] * 1000
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'max_ms': latencies[-1] * 1000,
+    }
+
+def print_results(task_count, results):
+    print('\n{0} tasks'.format(task_count))
+    print('{0:<16} {1:>10} {2:>9} {3:>9} {4:>9} {5:>9} {6:>7}'.format('route', 'req/s', 'p50 ms', 'p95 ms',
+                                                                      'p99 ms', 'max ms', 'errors'))
+    for name, result in results.items():
+        if ('p95_ms' in result):
+            print('{0:<16} {1:>10.1f} {2:>9.2f} {3:>9.2f} {4:>9.2f} {5:>9.2f} {6:>7}'.format(
+                name, result['throughput'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                result['max_ms'], result['errors']))
+        else:
+            print(name)
+        # anything else a scenario reports, e.g. blob calls or 429 counts
+        for key, value in result.items():
+            if (key not in LATENCY_KEYS):
+                print('{0:<16} {1}: {2}'.format('', key, value))
+
+def compare(baseline, runs, tolerance):
+    """
+    returns the routes whose p95 latency grew by more than tolerance over the baseline
+    """
+    regressions = []
+    for task_count, results in runs.items():
+        for name, result in results.items():
+            previous = baseline.get(task_count, {}).get(name)
+            if (previous is None or 'p95_ms' not in result):
+                continue
+            if (result['p95_ms'] > previous['p95_ms'] * (1 + tolerance)):
+                regressions.append('{0} tasks {1}: p95 {2:.2f} ms, baseline {3:.2f} ms'.format(
+                    task_count, name, result['p95_ms'], previous['p95_ms']))
+    return regressions
+
+def main(argv):
+    args = parse_args(argv)
+    benchmark = Benchmark(args)
+    scenario = getattr(benchmark, 'scenario_' + args.scenario)
+    runs = {}
+    try:
+        for task_count in args.tasks:
+            results = scenario(task_count)
+            print_results(task_count, results)
+            runs[str(task_count)] = results
+    finally:
+        benchmark.cleanup()
+    bRV = all(result.get('errors', 0) == 0 for results in runs.values() for result in results.values())
+
+    if (args.output):
+        with open(args.output, 'w') as f:
+            json.dump({'scenario': args.scenario, 'backend': args.backend, 'layout': args.layout, 'runs': runs}, f, indent=2)
+    if (args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['runs']
+        regressions = compare(baseline, runs, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if (regressions):
+            bRV = False
+    return 0 if bRV else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
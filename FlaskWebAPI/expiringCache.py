@@ -0,0 +1,56 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ExpiringLRUCache(object):
+    """
+    Bounded, thread safe cache where every entry has its own expiry time. When full, the
+    least recently used entry is evicted. Keeps hit/miss counters.
+    """
+    def __init__(self, max_len):
+        self.max_len = max_len
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def get(self, key):
+        """
+        returns the value, or None when there is no entry or it has expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None):
+                value, expires_at = entry
+                if (expires_at > time.time()):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, expires_at):
+        """
+        expires_at is an absolute time, as returned by time.time()
+        """
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while (len(self._entries) > self.max_len):
+                self._entries.popitem(last=False)
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if (total == 0):
+            return 0.0
+        return self.hits / total
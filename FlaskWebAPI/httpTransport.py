@@ -0,0 +1,76 @@
+import threading
+
+# Shared HTTP transport for the identity (Azure AD) and Key Vault calls. One pooled,
+# keep-alive session per process, with explicit timeouts and retry with backoff.
+# requests is imported when the session is first needed, not at module import.
+
+CONNECT_TIMEOUT = 3.05      # seconds
+READ_TIMEOUT = 10           # seconds
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.3         # seconds, doubled on every retry
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# only idempotent requests are retried, a POST such as the token exchange may have been 
+# processed before it failed
+RETRY_METHODS = frozenset(['HEAD', 'GET', 'OPTIONS'])
+DEFAULT_POOL_SIZE = 10
+# connection pool size per host, for the hosts we talk to the most
+HOST_POOL_SIZES = {
+    'https://login.microsoftonline.com': 20,
+}
+
+_session = None
+_session_lock = threading.Lock()
+
+def _retry():
+    from urllib3.util.retry import Retry
+    return Retry(total=MAX_RETRIES,
+                 backoff_factor=RETRY_BACKOFF,
+                 status_forcelist=RETRY_STATUS,
+                 allowed_methods=RETRY_METHODS,
+                 raise_on_status=False)
+
+def get_session():
+    global _session
+    if (_session is None):
+        with _session_lock:
+            if (_session is None):
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                session.mount('https://', HTTPAdapter(pool_maxsize=DEFAULT_POOL_SIZE, max_retries=_retry()))
+                session.mount('http://', HTTPAdapter(pool_maxsize=DEFAULT_POOL_SIZE, max_retries=_retry()))
+                for prefix, pool_size in HOST_POOL_SIZES.items():
+                    session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=_retry()))
+                _session = session
+    return _session
+
+def new_session(pool_size=DEFAULT_POOL_SIZE):
+    """
+    A pooled, keep-alive session of its own, without our retries, for SDK clients that 
+    retry by themselves and change the session's default headers (the storage SDK)
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
+    session.mount('http://', HTTPAdapter(pool_maxsize=pool_size))
+    return session
+
+def get(url, **kwargs):
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return get_session().get(url, **kwargs)
+
+def post(url, **kwargs):
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return get_session().post(url, **kwargs)
+
+def configure_msrest_client(client):
+    """
+    Applies the same timeout, retry and keep-alive settings to an msrest based Azure SDK
+    client, such as KeyVaultClient, which manages its own requests session
+    """
+    client.config.connection.timeout = READ_TIMEOUT
+    client.config.retry_policy.retries = MAX_RETRIES
+    client.config.retry_policy.backoff_factor = RETRY_BACKOFF
+    client.config.keep_alive = True
+    return client
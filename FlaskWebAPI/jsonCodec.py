@@ -0,0 +1,105 @@
+import json
+import os
+
+# JSON codec shared by the blob storage layer and the Flask responses. Uses orjson or
+# msgspec when one of them is installed and falls back to the standard json module
+# otherwise. JSON_CODEC=orjson|msgspec|json forces a backend.
+
+_orjson = None
+_msgspec = None
+_TaskBlob = None
+
+def _load_backend(requested):
+    global _orjson, _msgspec, _TaskBlob
+    if (requested in (None, 'orjson')):
+        try:
+            import orjson
+            _orjson = orjson
+            return 'orjson'
+        except ImportError:
+            pass
+    if (requested in (None, 'msgspec')):
+        try:
+            import msgspec
+            from typing import List, Tuple, TypedDict, Union
+
+            class TaskFields(TypedDict):
+                id: int
+                title: str
+                description: str
+                done: bool
+
+            class Task(TaskFields, total=False):
+                rev: int
+
+            class TaskDocumentFields(TypedDict):
+                rev: int
+                pruned_rev: int
+                deleted: List[Tuple[int, int]]
+                tasks: List[Task]
+
+            class TaskDocument(TaskDocumentFields, total=False):
+                generation: int
+
+            _msgspec = msgspec
+            _TaskBlob = Union[List[Task], TaskDocument]
+            return 'msgspec'
+        except ImportError:
+            pass
+    return 'json'
+
+BACKEND = _load_backend(os.environ.get('JSON_CODEC'))
+
+class TaskDecodeError(ValueError):
+    def __init__(self, details):
+        super().__init__('Invalid task list: ' + details)
+
+def dumps_bytes(obj):
+    if (_orjson is not None):
+        return _orjson.dumps(obj)
+    if (_msgspec is not None):
+        return _msgspec.json.encode(obj)
+    return json.dumps(obj).encode('utf-8')
+
+def dumps(obj):
+    if (_orjson is not None):
+        return _orjson.dumps(obj).decode('utf-8')
+    if (_msgspec is not None):
+        return _msgspec.json.encode(obj).decode('utf-8')
+    return json.dumps(obj)
+
+def loads(text):
+    if (_orjson is not None):
+        return _orjson.loads(text)
+    if (_msgspec is not None):
+        return _msgspec.json.decode(text)
+    return json.loads(text)
+
+def decode_task_blob(text):
+    """
+    Decodes the content of the task list blob: a list of task dicts (the format written
+    before task revisions) or a dict with 'rev', 'pruned_rev', 'deleted', 'tasks' and, for 
+    the snapshot of the log layout, 'generation'. With
+    msgspec the records are checked against the task schema while decoding; a blob that 
+    does not match it (values of other types, written by an older version or another 
+    client) is decoded again like the other backends do, checking the outer shape only.
+    """
+    if (_msgspec is not None):
+        try:
+            return _msgspec.json.decode(text, type=_TaskBlob)
+        except _msgspec.ValidationError:
+            pass
+    decoded = loads(text)
+    if (isinstance(decoded, dict)):
+        if (not isinstance(decoded.get('tasks'), list)):
+            raise TaskDecodeError('no task list')
+    elif (not isinstance(decoded, list)):
+        raise TaskDecodeError('not a list')
+    return decoded
+
+def response(obj, status=200):
+    """
+    Flask response with the JSON encoded object, used instead of jsonify
+    """
+    from flask import Response
+    return Response(dumps_bytes(obj), status=status, mimetype='application/json')
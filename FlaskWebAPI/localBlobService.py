@@ -0,0 +1,355 @@
+import itertools
+import os
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+# Storage backends that stand in for the azure-storage-blob BlockBlobService and
+# AppendBlobService, implementing the calls StorageBlobServiceWrapper makes (exists,
+# create_container, get_blob_properties, get_blob_to_text/bytes, create_blob_from_text/
+# stream, delete_blob, list_blob_names, and create_blob/append_block of append blobs)
+# with the same conditional semantics: if_match / appendpos_condition fail with 412,
+# if_none_match with 409 and a read range starting at the end of the blob with 416.
+# They need no account key, so the task API can be run and measured without Azure.
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class LocalBlobError(Exception):
+    """
+    Raised with the HTTP status the storage service would return, see status_code
+    """
+    def __init__(self, status_code, message):
+        super().__init__('{0} {1}'.format(status_code, message))
+        self.status_code = status_code
+
+
+class BlobProperties(object):
+    def __init__(self, etag, last_modified, content_length, append_offset=None):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_length = content_length
+        self.append_offset = append_offset
+
+
+class Blob(object):
+    def __init__(self, content, properties):
+        self.content = content
+        self.properties = properties
+
+
+def _check_conditions(name, current_etag, if_match, if_none_match):
+    if (if_match is not None):
+        if (current_etag is None or (if_match != '*' and if_match != current_etag)):
+            raise LocalBlobError(412, 'Condition not met: ' + name)
+    if (if_none_match is not None and current_etag is not None):
+        if (if_none_match == '*' or if_none_match == current_etag):
+            raise LocalBlobError(409, 'Blob already exists: ' + name)
+
+def _check_append_position(name, length, appendpos_condition):
+    if (appendpos_condition is not None and appendpos_condition != length):
+        raise LocalBlobError(412, 'Append position condition not met: ' + name)
+
+def _check_range(name, length, start_range):
+    if (start_range is not None and start_range >= length):
+        raise LocalBlobError(416, 'Range not satisfiable: ' + name)
+
+def _read_stream(stream):
+    content = bytearray()
+    while True:
+        chunk = stream.read(STREAM_CHUNK_SIZE)
+        if (not chunk):
+            break
+        content += chunk
+    return bytes(content)
+
+
+class MemoryBlobService(object):
+    """
+    Blobs kept in a dict for the life of the process. Nothing is shared between processes.
+    """
+    def __init__(self):
+        self._containers = set()
+        self._blobs = {}
+        self._etags = itertools.count(1)
+        self._lock = threading.Lock()
+        return
+
+    def exists(self, container_name, blob_name=None):
+        if (blob_name is None):
+            return container_name in self._containers
+        return (container_name, blob_name) in self._blobs
+
+    def create_container(self, container_name, **kwargs):
+        with self._lock:
+            created = container_name not in self._containers
+            self._containers.add(container_name)
+        return created
+
+    def get_blob_properties(self, container_name, blob_name, **kwargs):
+        return Blob(None, self._get(container_name, blob_name)[1])
+
+    def get_blob_to_text(self, container_name, blob_name, encoding='utf-8', **kwargs):
+        content, properties = self._get(container_name, blob_name)
+        return Blob(bytes(content).decode(encoding), properties)
+
+    def get_blob_to_bytes(self, container_name, blob_name, start_range=None, end_range=None, **kwargs):
+        content, properties = self._get(container_name, blob_name)
+        _check_range(blob_name, len(content), start_range)
+        start = start_range or 0
+        end = len(content) if (end_range is None) else end_range + 1
+        return Blob(bytes(content[start:end]), properties)
+
+    def create_blob(self, container_name, blob_name, if_match=None, if_none_match=None, **kwargs):
+        # an empty append blob, its content grows in place
+        return self._put(container_name, blob_name, bytearray(), if_match, if_none_match)
+
+    def append_block(self, container_name, blob_name, block, appendpos_condition=None, **kwargs):
+        with self._lock:
+            content, properties = self._get(container_name, blob_name)
+            _check_append_position(blob_name, len(content), appendpos_condition)
+            offset = len(content)
+            content.extend(block)
+            properties = BlobProperties('"0x{0:x}"'.format(next(self._etags)),
+                                        datetime.now(timezone.utc), len(content), offset)
+            self._blobs[(container_name, blob_name)] = (content, properties)
+        return properties
+
+    def create_blob_from_text(self, container_name, blob_name, text, encoding='utf-8',
+                              if_match=None, if_none_match=None, **kwargs):
+        return self._put(container_name, blob_name, text.encode(encoding), if_match, if_none_match)
+
+    def create_blob_from_stream(self, container_name, blob_name, stream,
+                                if_match=None, if_none_match=None, **kwargs):
+        return self._put(container_name, blob_name, _read_stream(stream), if_match, if_none_match)
+
+    def delete_blob(self, container_name, blob_name, **kwargs):
+        with self._lock:
+            if (self._blobs.pop((container_name, blob_name), None) is None):
+                raise LocalBlobError(404, 'Blob not found: ' + blob_name)
+
+    def list_blob_names(self, container_name, prefix=None, **kwargs):
+        return sorted(name for (container, name) in list(self._blobs)
+                      if container == container_name and (prefix is None or name.startswith(prefix)))
+
+    def _get(self, container_name, blob_name):
+        entry = self._blobs.get((container_name, blob_name))
+        if (entry is None):
+            raise LocalBlobError(404, 'Blob not found: ' + blob_name)
+        return entry
+
+    def _put(self, container_name, blob_name, content, if_match, if_none_match):
+        with self._lock:
+            if (container_name not in self._containers):
+                raise LocalBlobError(404, 'Container not found: ' + container_name)
+            entry = self._blobs.get((container_name, blob_name))
+            _check_conditions(blob_name, entry and entry[1].etag, if_match, if_none_match)
+            properties = BlobProperties('"0x{0:x}"'.format(next(self._etags)),
+                                        datetime.now(timezone.utc), len(content))
+            self._blobs[(container_name, blob_name)] = (content, properties)
+        return properties
+
+
+class LocalBlobService(object):
+    """
+    Blobs stored as files under root/<container>/<blob name>. Every write goes to a
+    temporary file that is renamed over the blob, so readers always see a complete blob.
+    Append blobs are appended to in place, under the lock described below; readers of 
+    their tail should only use complete records.
+    The ETag is derived from the file's inode, modification time and size. With use_mmap
+    the blobs are read through a memory map instead of read() calls. Conditional writes
+    are serialized per container through a lock file (fcntl, where available) so several
+    worker processes can share one directory.
+    """
+    def __init__(self, root, use_mmap=False, fsync=False):
+        self.root = os.path.abspath(root)
+        self.use_mmap = use_mmap
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        return
+
+    def exists(self, container_name, blob_name=None):
+        if (blob_name is None):
+            return os.path.isdir(self._container_path(container_name))
+        return os.path.isfile(self._blob_path(container_name, blob_name))
+
+    def create_container(self, container_name, **kwargs):
+        path = self._container_path(container_name)
+        created = not os.path.isdir(path)
+        os.makedirs(path, exist_ok=True)
+        return created
+
+    def get_blob_properties(self, container_name, blob_name, **kwargs):
+        try:
+            stat = os.stat(self._blob_path(container_name, blob_name))
+        except FileNotFoundError:
+            raise LocalBlobError(404, 'Blob not found: ' + blob_name)
+        return Blob(None, self._properties(stat))
+
+    def get_blob_to_text(self, container_name, blob_name, encoding='utf-8', **kwargs):
+        try:
+            f = open(self._blob_path(container_name, blob_name), 'rb')
+        except FileNotFoundError:
+            raise LocalBlobError(404, 'Blob not found: ' + blob_name)
+        with f:
+            # the open file is the version we read, even if a writer renames a new one over it
+            stat = os.fstat(f.fileno())
+            if (self.use_mmap and stat.st_size > 0):
+                import mmap
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    content = str(mapped, encoding)
+            else:
+                content = f.read().decode(encoding)
+        return Blob(content, self._properties(stat))
+
+    def get_blob_to_bytes(self, container_name, blob_name, start_range=None, end_range=None, **kwargs):
+        try:
+            f = open(self._blob_path(container_name, blob_name), 'rb')
+        except FileNotFoundError:
+            raise LocalBlobError(404, 'Blob not found: ' + blob_name)
+        with f:
+            stat = os.fstat(f.fileno())
+            _check_range(blob_name, stat.st_size, start_range)
+            f.seek(start_range or 0)
+            if (end_range is None):
+                content = f.read()
+            else:
+                content = f.read(end_range + 1 - (start_range or 0))
+        return Blob(content, self._properties(stat))
+
+    def create_blob(self, container_name, blob_name, if_match=None, if_none_match=None, **kwargs):
+        # an empty append blob
+        return self._put(container_name, blob_name, lambda f: None, if_match, if_none_match)
+
+    def append_block(self, container_name, blob_name, block, appendpos_condition=None, **kwargs):
+        path = self._blob_path(container_name, blob_name)
+        with self._container_lock(container_name):
+            try:
+                f = open(path, 'r+b')
+            except FileNotFoundError:
+                raise LocalBlobError(404, 'Blob not found: ' + blob_name)
+            with f:
+                offset = f.seek(0, os.SEEK_END)
+                _check_append_position(blob_name, offset, appendpos_condition)
+                f.write(block)
+                f.flush()
+                if (self.fsync):
+                    os.fsync(f.fileno())
+                stat = os.fstat(f.fileno())
+        properties = self._properties(stat)
+        properties.append_offset = offset
+        return properties
+
+    def create_blob_from_text(self, container_name, blob_name, text, encoding='utf-8',
+                              if_match=None, if_none_match=None, **kwargs):
+        return self._put(container_name, blob_name,
+                         lambda f: f.write(text.encode(encoding)), if_match, if_none_match)
+
+    def create_blob_from_stream(self, container_name, blob_name, stream,
+                                if_match=None, if_none_match=None, **kwargs):
+        def write(f):
+            while True:
+                chunk = stream.read(STREAM_CHUNK_SIZE)
+                if (not chunk):
+                    break
+                f.write(chunk)
+        return self._put(container_name, blob_name, write, if_match, if_none_match)
+
+    def delete_blob(self, container_name, blob_name, **kwargs):
+        with self._container_lock(container_name):
+            try:
+                os.remove(self._blob_path(container_name, blob_name))
+            except FileNotFoundError:
+                raise LocalBlobError(404, 'Blob not found: ' + blob_name)
+
+    def list_blob_names(self, container_name, prefix=None, **kwargs):
+        container_path = self._container_path(container_name)
+        names = []
+        for directory, subdirectories, files in os.walk(container_path):
+            for file_name in files:
+                if (file_name.startswith('.')):
+                    continue        # lock and temporary files
+                name = os.path.relpath(os.path.join(directory, file_name), container_path).replace(os.sep, '/')
+                if (prefix is None or name.startswith(prefix)):
+                    names.append(name)
+        return sorted(names)
+
+    def _container_path(self, container_name):
+        return os.path.join(self.root, container_name)
+
+    def _blob_path(self, container_name, blob_name):
+        parts = blob_name.split('/')
+        if ('' in parts or '.' in parts or '..' in parts or parts[-1].startswith('.')):
+            raise LocalBlobError(400, 'Invalid blob name: ' + blob_name)
+        return os.path.join(self._container_path(container_name), *parts)
+
+    def _properties(self, stat):
+        etag = '"0x{0:x}{1:x}{2:x}"'.format(stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        return BlobProperties(etag, datetime.fromtimestamp(stat.st_mtime, timezone.utc), stat.st_size)
+
+    def _current_etag(self, path):
+        try:
+            return self._properties(os.stat(path)).etag
+        except FileNotFoundError:
+            return None
+
+    def _put(self, container_name, blob_name, write, if_match, if_none_match):
+        path = self._blob_path(container_name, blob_name)
+        if (not os.path.isdir(self._container_path(container_name))):
+            raise LocalBlobError(404, 'Container not found: ' + container_name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # the content is written before taking the lock, only the check and rename hold it
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+                if (self.fsync):
+                    f.flush()
+                    os.fsync(f.fileno())
+            with self._container_lock(container_name):
+                _check_conditions(blob_name, self._current_etag(path), if_match, if_none_match)
+                os.replace(temp_path, path)
+                stat = os.stat(path)
+        except BaseException:
+            if (os.path.exists(temp_path)):
+                os.remove(temp_path)
+            raise
+        return self._properties(stat)
+
+    def _container_lock(self, container_name):
+        return _FileLock(self._lock, os.path.join(self._container_path(container_name), '.lock'))
+
+
+class _FileLock(object):
+    """
+    The thread lock, plus an exclusive lock on lock_path for other processes when fcntl exists
+    """
+    def __init__(self, thread_lock, lock_path):
+        self.thread_lock = thread_lock
+        self.lock_path = lock_path
+        self._file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if (fcntl is not None):
+            try:
+                self._file = open(self.lock_path, 'a')
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            except BaseException:
+                self.__exit__(None, None, None)
+                raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if (self._file is not None):
+            self._file.close()      # closing releases the flock
+            self._file = None
+        self.thread_lock.release()
+        return False
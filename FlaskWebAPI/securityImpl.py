@@ -1,13 +1,38 @@
 from validateJWT import InvalidAuthorizationToken, validateJWT
 #from flask import Flask, jsonify, abort, make_response
 from flask import request, Response
-from expiringdict import ExpiringDict
+from expiringCache import ExpiringLRUCache
+import hashlib
 import json
+import logging
+import os
+import threading
+import time
 import storageBlobService
 import appSecrets
+import httpTransport
+import metrics
+import sharedCache
+import admissionControl
 
 MX_NUM_USER=1000
-MX_TOKEN_AGE=300 # seconds, 5 minutes
+MX_TOKEN_AGE=300 # seconds, 5 minutes. Used when the token endpoint does not say 'expires_in'
+OBO_REFRESH_AHEAD=60 # seconds, on-behalf-of tokens this close to expiry are refreshed in the background
+SHARED_STORAGE_KEY_SECONDS=3600 # how long other worker processes may use a storage key read from the Key Vault
+# Admission control, checked right after the token is validated. Each user (oid) may make
+# RATE_LIMIT_PER_SECOND requests per second on average, in bursts of up to RATE_LIMIT_BURST.
+# At most MAX_ACTIVE_REQUESTS requests are processed at once, MAX_QUEUED_REQUESTS more wait
+# up to QUEUE_TIMEOUT seconds for their turn. Requests over a limit get 429 with Retry-After.
+# All can be overridden through environment variables of the same name. RATE_LIMIT_PER_SECOND 0
+# or RATE_LIMIT_BURST below 1 turns the rate limit off, MAX_ACTIVE_REQUESTS 0 the concurrency
+# limit; MAX_QUEUED_REQUESTS 0 turns away at once what finds no free slot.
+RATE_LIMIT_PER_SECOND = float(os.environ.get('RATE_LIMIT_PER_SECOND', 50))
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 100))
+MAX_ACTIVE_REQUESTS = int(os.environ.get('MAX_ACTIVE_REQUESTS', 16))
+MAX_QUEUED_REQUESTS = int(os.environ.get('MAX_QUEUED_REQUESTS', 64))
+QUEUE_TIMEOUT = float(os.environ.get('QUEUE_TIMEOUT', 2.0))
+
+log = logging.getLogger(__name__)
 
 class securityImpl:
     """
@@ -20,55 +45,152 @@ class securityImpl:
 		#self.ClientId = appSecrets.ClientId
 		#self.ClientSecret = appSecrets.ClientSecret
 		#self.TenantId = appSecrets.TenantId
-        self.userIdCache = ExpiringDict(max_len=MX_NUM_USER, max_age_seconds=MX_TOKEN_AGE)
+        # optional, shares the Key Vault and token endpoint results with the other workers
+        self.sharedCache = sharedCache.get_shared_cache()
+        self.oboTokenCache = OboTokenCache(MX_NUM_USER, OBO_REFRESH_AHEAD, shared_cache=self.sharedCache)
+        # one KeyVaultClient for all the calls, see get_keyVaultClient; the token of a 
+        # call is passed to it per thread
+        self.keyVaultClient = None
+        self.keyVaultClientLock = threading.Lock()
+        self.keyVaultToken = threading.local()
         self.storageObject = storageBlobService.StorageBlobServiceWrapper(appSecrets.KV_Storage_AccountName)
-        self.storageKeyLoaded = False
+        # the local storage backends have no key to fetch from the Key Vault
+        self.storageKeyLoaded = not self.storageObject.needs_storageKey()
+        self.rateLimiter = None
+        if (RATE_LIMIT_PER_SECOND > 0 and RATE_LIMIT_BURST >= 1):
+            self.rateLimiter = admissionControl.TokenBucketLimiter(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST, MX_NUM_USER)
+        self.concurrencyLimiter = None
+        if (MAX_ACTIVE_REQUESTS > 0):
+            self.concurrencyLimiter = admissionControl.ConcurrencyLimiter(MAX_ACTIVE_REQUESTS, MAX_QUEUED_REQUESTS, QUEUE_TIMEOUT)
         return
 
     def get_StorageObject(self):
         return self.storageObject
 
+    def prewarm(self, load_storage_key=False):
+        """
+        Does up front what the first requests would otherwise wait for: fetches the token 
+        signing keys and, with load_storage_key, reads the storage key using the WebAPI's 
+        own identity. Once there is storage access (always, for the local storage backends) 
+        it checks the storage container and blob. Failures are not fatal, the requests 
+        then do the work as before.
+        """
+        self.jwtValidator.prewarm()
+        if (load_storage_key and self.storageKeyLoaded == False):
+            storage_key, response = self.getStorageKeySecret(None)
+            if (not (storage_key is None)):
+                self.storageObject.set_storageKey(storage_key)
+                self.storageKeyLoaded = True
+        if (self.storageKeyLoaded):
+            try:
+                self.storageObject.prewarm()
+            except Exception as ex:
+                log.warning('Pre-loading the task storage failed: %s', ex)
+
     def validateRequest(self,request):
+        """
+        Returns (True, None) for a request that may be processed, the caller must then call 
+        release() once it is done. Otherwise returns False and the error response.
+        """
         bRV = False
         response = None
-        scopeTest = 'user_impersonation'
 
         # first ask the jwt to validate that the request contains correct Bearer token
         btempRV, bearerToken, decodedToken = self.jwtValidator.validate_request(request)
         if (btempRV and bearerToken and decodedToken):
-            # further validation 
-            if (decodedToken['aud'] in self.valid_audiences):       # audience should include our instance
-                if (decodedToken['scp'] == scopeTest):             # for the user_impersonation, this value should be present
-                    # assume ['oid'] value is present in our cache 
-                    if (decodedToken['oid'] not in self.userIdCache):
-                        # indicates that we've not seen this user before. 
-                        # Validate that he/she has
-                        # been authorised to access the KeyVault APIs
-                        btempRV, response = self.validateUserCredentials(bearerToken)
-                        if (btempRV):
-                            # add into our cache
-                            self.userIdCache['oid'] = bearerToken
-                            # If our Storage API Keys are not loaded, now is the time to load them
-                            # Remember, this is executed only once for the first authenticated/authorised user
-                            if (self.storageKeyLoaded == False):
-                                access_token = json.loads(response.text)
-                                # Assume that our storage access was not created and create it
-                                storage_key, response = self.getStorageKeySecret(access_token)
-                                # Also creates the storage service internally
-                                if (not (storage_key is None)):
-                                    self.storageObject.set_storageKey(storage_key)
-                                    self.storageKeyLoaded = True
-                                    bRV = True
-                            else:
-                                bRV = True
-                else:
-                    response = Response('Unauthorized', 401, {'Content-Type': 'text/html', 'WWW-Authenticate': 'Invalid Scope'})
-            else:
-                response = Response('Unauthorized', 401, {'Content-Type': 'text/html', 'WWW-Authenticate': 'Invalid Audience'})
+            user = tokenUser(decodedToken)
+            if (user is None):
+                return bRV, Response('Unauthorized', 401, {'Content-Type': 'text/html', 'WWW-Authenticate': 'Bearer Token without a user (oid or sub)'})
+            # then admission control, before any call to Azure AD or the storage
+            response = self.admitRequest(user)
+            if (response is not None):
+                return bRV, response
+            try:
+                bRV, response = self.validateClaims(bearerToken, decodedToken)
+            finally:
+                if (not bRV):
+                    self.release()
         else:
             response = Response('Unauthorized', 401, {'Content-Type': 'text/html', 'WWW-Authenticate': 'Bearer Token, Decoded Token security error'})
         return bRV, response
+
+    def admitRequest(self, user):
+        """
+        Applies the per user rate limit and the concurrency limit. Returns None when the 
+        request was admitted, otherwise the 429 response.
+        """
+        if (self.rateLimiter is not None):
+            wait = self.rateLimiter.acquire(user)
+            if (wait > 0):
+                return self.tooManyRequests(wait)
+        if (self.concurrencyLimiter is not None):
+            with metrics.span('admission_queue'):
+                bAdmitted = self.concurrencyLimiter.acquire()
+            if (not bAdmitted):
+                return self.tooManyRequests(self.concurrencyLimiter.queue_timeout)
+        return None
+
+    def release(self):
+        """
+        Ends a request that validateRequest admitted
+        """
+        if (self.concurrencyLimiter is not None):
+            self.concurrencyLimiter.release()
+
+    def tooManyRequests(self, retry_after_seconds):
+        return Response('Too Many Requests', 429, {'Content-Type': 'text/html', 
+                                                   'Retry-After': admissionControl.retry_after(retry_after_seconds)})
+
+    def validateClaims(self, bearerToken, decodedToken):
+        """
+        Checks the audience and scope of a valid token and the user's access to the Key Vault
+        """
+        bRV = False
+        response = None
+        scopeTest = 'user_impersonation'
+        # further validation 
+        with metrics.span('claims_check'):
+            bAudience = decodedToken['aud'] in self.valid_audiences      # audience should include our instance
+            bScope = decodedToken['scp'] == scopeTest                   # for the user_impersonation, this value should be present
+        if (bAudience):
+            if (bScope):
+                # Validate that the user has been authorised to access the KeyVault APIs by
+                # exchanging the token on-behalf-of the user. The exchanged token is cached 
+                # per user and bearer token, so this goes to Azure AD only when we've not 
+                # seen this user and token before or the exchanged token is about to expire
+                cacheKey = '{0}:{1}'.format(tokenUser(decodedToken), hashlib.sha256(bearerToken.encode('utf-8')).hexdigest())
+                access_token, response = self.oboTokenCache.get_token(cacheKey, 
+                                                                      lambda: self.exchangeUserCredentials(bearerToken))
+                if (access_token is not None):
+                    # If our Storage API Keys are not loaded, now is the time to load them
+                    # Remember, this is executed only once for the first authenticated/authorised user
+                    if (self.storageKeyLoaded == False):
+                        # Assume that our storage access was not created and create it
+                        storage_key, response = self.getStorageKeySecret(access_token)
+                        # Also creates the storage service internally
+                        if (not (storage_key is None)):
+                            self.storageObject.set_storageKey(storage_key)
+                            self.storageKeyLoaded = True
+                            bRV = True
+                    else:
+                        bRV = True
+            else:
+                response = Response('Unauthorized', 401, {'Content-Type': 'text/html', 'WWW-Authenticate': 'Invalid Scope'})
+        else:
+            response = Response('Unauthorized', 401, {'Content-Type': 'text/html', 'WWW-Authenticate': 'Invalid Audience'})
+        return bRV, response
        
+    def exchangeUserCredentials(self, bearerToken):
+        """
+        returns the on-behalf-of access token (the parsed token endpoint response) and None, 
+        or None and the error response
+        """
+        with metrics.span('obo_exchange'):
+            btempRV, response = self.validateUserCredentials(bearerToken)
+        if (btempRV):
+            return json.loads(response.text), None
+        return None, response
+
     def validateUserCredentials(self,bearerToken) :
         bRV = False
         r = None
@@ -83,8 +205,6 @@ class securityImpl:
         return bRV, r
    
     def get_token_with_authorization_code(self, bearerToken):
-        import requests
-
         resp = None
 
         # construct our Azure AD obo message
@@ -106,34 +226,34 @@ class securityImpl:
         }
 
         URL = 'https://login.microsoftonline.com/{0}/oauth2/token'.format(appSecrets.TenantId)
-        resp = requests.post(URL, headers=headers,  data=params) 
+        resp = httpTransport.post(URL, headers=headers,  data=params) 
         return resp
 
     def getStorageKeySecret(self,token_credentials):
-        from msrestazure.azure_active_directory import AADTokenCredentials
-        resourceKeyVault ="https://vault.azure.net"
+        """
+        Reads the storage key from the Key Vault on-behalf-of the user whose token is passed.
+        With token_credentials None the WebAPI's own identity is used, which only works if 
+        the WebAPI has been given access to the Key Vault (see auth_callback). A key another 
+        worker read recently is taken from the shared cache instead.
+        """
+        if (self.sharedCache is not None):
+            storage_key = self.sharedCache.get('storage_key')
+            if (storage_key is not None):
+                return storage_key, None
+
+        from azure.keyvault.models import KeyVaultErrorException
         secret_bundle = None
         try:
-            credentials = AADTokenCredentials(
-                token = token_credentials,
-                client_id = appSecrets.ClientId,
-                tenant = appSecrets.TenantId,
-                resource = resourceKeyVault
-            )
-   
-            from azure.keyvault import KeyVaultClient, KeyVaultAuthentication
-            from azure.keyvault.models import KeyVaultErrorException
-    
-            #Works the following
-            kvAuth = KeyVaultAuthentication(credentials=credentials)
-            client = KeyVaultClient(kvAuth)
-
-            # Following will also work, if the WebAPI is given permission to access Key Vault permissions
-            #client = KeyVaultClient(KeyVaultAuthentication(auth_callback))
-        
-            secret_bundle = client.get_secret(appSecrets.KV_VAULT_URL, 
-                                              appSecrets.KV_Storage_AccountKeyName, 
-                                              appSecrets.KV_Storage_SECRET_VERSION)
+            client = self.get_keyVaultClient()
+            # the client asks keyVaultAuthorization for the token of this call
+            self.keyVaultToken.value = token_credentials
+            try:
+                with metrics.span('key_vault'):
+                    secret_bundle = client.get_secret(appSecrets.KV_VAULT_URL, 
+                                                      appSecrets.KV_Storage_AccountKeyName, 
+                                                      appSecrets.KV_Storage_SECRET_VERSION)
+            finally:
+                self.keyVaultToken.value = None
 
         except KeyVaultErrorException as ex:
             print(ex)
@@ -142,8 +262,33 @@ class securityImpl:
         except Exception as eex:
             print(eex)
             return None, None
+        if (self.sharedCache is not None):
+            self.sharedCache.set('storage_key', secret_bundle.value, time.time() + SHARED_STORAGE_KEY_SECONDS)
         return secret_bundle.value, None
 
+    def get_keyVaultClient(self):
+        """
+        The KeyVaultClient, made on first use and then reused with its connections. It gets 
+        the token of each call from keyVaultAuthorization.
+        """
+        if (self.keyVaultClient is None):
+            from azure.keyvault import KeyVaultClient, KeyVaultAuthentication
+            with self.keyVaultClientLock:
+                if (self.keyVaultClient is None):
+                    kvAuth = KeyVaultAuthentication(self.keyVaultAuthorization)
+                    self.keyVaultClient = httpTransport.configure_msrest_client(KeyVaultClient(kvAuth))
+        return self.keyVaultClient
+
+    def keyVaultAuthorization(self, server, resource, scope):
+        """
+        Authorization callback of the KeyVaultClient: the on-behalf-of token the calling 
+        thread is using, or the WebAPI's own identity (auth_callback) when it has none
+        """
+        token = getattr(self.keyVaultToken, 'value', None)
+        if (token is None):
+            return securityImpl.auth_callback(server, resource, scope)
+        return token['token_type'], token['access_token']
+
     def auth_callback(server, resource, scope):
         '''
         This function is not called /should not be called in normal circumstances; Only relevant for 
@@ -166,3 +311,103 @@ class securityImpl:
         return token['token_type'], token['access_token']
 
 
+def tokenUser(decodedToken):
+    """
+    The user a validated token was issued to: its object id ('oid'), or its subject ('sub') 
+    for tokens without one. None when it has neither.
+    """
+    return decodedToken.get('oid') or decodedToken.get('sub')
+
+
+class _InflightExchange(object):
+    def __init__(self):
+        self.access_token = None
+        self.response = None
+        self.error = None       # what exchange() raised, raised again in every waiting request
+        self.done = threading.Event()
+
+
+class OboTokenCache(object):
+    """
+    Per user cache of on-behalf-of access tokens, kept until their real expiry ('expires_in'). 
+    Tokens that get within refresh_ahead seconds of expiry are refreshed in the background 
+    while the current one is still served. Concurrent requests for the same key share one 
+    in-flight exchange with the token endpoint, and get its result or the exception it 
+    raised. With a shared_cache, a token that another 
+    worker process got is used instead of exchanging again.
+    """
+    def __init__(self, max_len, refresh_ahead, shared_cache=None):
+        self.refresh_ahead = refresh_ahead
+        self.shared_cache = shared_cache
+        self._tokens = ExpiringLRUCache(max_len)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.external_calls = 0
+        return
+
+    def get_stats(self):
+        return {'hits': self._tokens.hits, 'misses': self._tokens.misses, 'external_calls': self.external_calls}
+
+    def get_token(self, key, exchange):
+        """
+        exchange() performs the token request and returns (access_token, error_response). 
+        Returns the same pair, from the cache when possible, or raises what exchange() raised.
+        """
+        entry = self._tokens.get(key)
+        if (entry is not None):
+            access_token, expires_at = entry
+            if ((expires_at - time.time()) <= self.refresh_ahead):
+                self._start_exchange(key, exchange, background=True)
+            return access_token, None
+
+        call, leader = self._start_exchange(key, exchange, background=False)
+        if (leader):
+            self._run_exchange(key, exchange, call)
+        else:
+            call.done.wait()
+        if (call.error is not None):
+            raise call.error
+        return call.access_token, call.response
+
+    def _start_exchange(self, key, exchange, background):
+        with self._lock:
+            call = self._inflight.get(key)
+            if (call is not None):
+                return call, False
+            call = _InflightExchange()
+            self._inflight[key] = call
+        if (background):
+            refresher = threading.Thread(target=self._refresh, args=(key, exchange, call))
+            refresher.daemon = True
+            refresher.start()
+        return call, True
+
+    def _refresh(self, key, exchange, call):
+        self._run_exchange(key, exchange, call)
+        if (call.error is not None):
+            # the current token is still served until it expires
+            log.warning('Refreshing an on-behalf-of token failed: %s', call.error)
+
+    def _run_exchange(self, key, exchange, call):
+        try:
+            if (self.shared_cache is not None):
+                entry = self.shared_cache.get('obo:' + key)
+                # only tokens that are not due for a refresh themselves
+                if (entry is not None and (entry[1] - time.time()) > self.refresh_ahead):
+                    call.access_token = entry[0]
+                    self._tokens.set(key, (entry[0], entry[1]), entry[1])
+                    return
+            with self._lock:
+                self.external_calls += 1
+            call.access_token, call.response = exchange()
+            if (call.access_token is not None):
+                expires_at = time.time() + float(call.access_token.get('expires_in', MX_TOKEN_AGE))
+                self._tokens.set(key, (call.access_token, expires_at), expires_at)
+                if (self.shared_cache is not None):
+                    self.shared_cache.set('obo:' + key, [call.access_token, expires_at], expires_at)
+        except Exception as ex:
+            call.error = ex
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.done.set()
@@ -0,0 +1,133 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import jsonCodec
+
+# Optional cache shared by all the worker processes of one host (wfastcgi, gunicorn,
+# uvicorn --workers), kept in a local SQLite file. Enabled by setting SHARED_CACHE_PATH to
+# the file to use. It holds, as plain JSON, so that a user or a key costs one external 
+# call per host instead of one per worker:
+# - 'jwks': the token signing keys of the tenant (public keys)
+# - 'obo:<oid>:<token hash>': the on-behalf-of access tokens, each usable against the Key 
+#   Vault as that user until it expires
+# - 'storage_key': the storage account key, full access to the task storage, for 
+#   SHARED_STORAGE_KEY_SECONDS (securityImpl)
+# The file and SQLite's -wal and -shm files next to it are made readable by their owner 
+# only (SQLite gives files it creates later the database file's permissions). Keep it in 
+# a directory on a local disk that only the app's account can read.
+# Failures of the shared cache are never fatal, the callers then go to the source.
+
+SHARED_CACHE_TIMEOUT = 1.0      # seconds to wait for a lock held by another process
+PURGE_EVERY = 500               # writes between removals of the expired entries
+
+log = logging.getLogger(__name__)
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+def get_shared_cache():
+    """
+    Returns the process wide SharedCache, or None when SHARED_CACHE_PATH is not set
+    """
+    global _shared_cache
+    path = os.environ.get('SHARED_CACHE_PATH')
+    if (not path):
+        return None
+    if (_shared_cache is None):
+        with _shared_cache_lock:
+            if (_shared_cache is None):
+                try:
+                    _shared_cache = SharedCache(path)
+                except (sqlite3.Error, OSError) as ex:
+                    log.warning('Opening the shared cache %s failed: %s', path, ex)
+                    return None
+    return _shared_cache
+
+
+class SharedCache(object):
+    """
+    Key/value entries, each with its own absolute expiry time, in a SQLite database used
+    concurrently by several processes. Values are anything jsonCodec can serialize.
+    """
+    def __init__(self, path, timeout=SHARED_CACHE_TIMEOUT):
+        self.path = os.path.abspath(path)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._writes = 0
+        if (not os.path.exists(self.path)):
+            os.close(os.open(self.path, os.O_CREAT | os.O_WRONLY, 0o600))
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                               '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)')
+        self._restrict_permissions()
+        return
+
+    def _restrict_permissions(self):
+        # also when the file was there already, and for the -wal and -shm files the 
+        # connection above opened
+        for path in (self.path, self.path + '-wal', self.path + '-shm'):
+            try:
+                os.chmod(path, 0o600)
+            except FileNotFoundError:
+                pass
+            except OSError as ex:
+                log.warning('Restricting the permissions of %s failed: %s', path, ex)
+
+    def get(self, key):
+        """
+        returns the value, or None when there is no entry, it has expired or the cache
+        cannot be read. An entry that is not valid JSON is removed.
+        """
+        try:
+            row = self._connection().execute('SELECT value, expires_at FROM entries WHERE key = ?',
+                                             (key,)).fetchone()
+        except sqlite3.Error as ex:
+            log.warning('Shared cache read failed: %s', ex)
+            return None
+        if (row is None or row[1] <= time.time()):
+            return None
+        try:
+            return jsonCodec.loads(row[0])
+        except (ValueError, TypeError) as ex:
+            # the caller goes to the source instead and writes a good entry
+            log.warning('Shared cache entry %s is damaged, removed: %s', key, ex)
+            self.remove(key)
+            return None
+
+    def set(self, key, value, expires_at):
+        """
+        expires_at is an absolute time, as returned by time.time()
+        """
+        try:
+            connection = self._connection()
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)',
+                                   (key, jsonCodec.dumps(value), expires_at))
+            self._writes += 1
+            if (self._writes % PURGE_EVERY == 0):
+                with connection:
+                    connection.execute('DELETE FROM entries WHERE expires_at <= ?', (time.time(),))
+        except sqlite3.Error as ex:
+            log.warning('Shared cache write failed: %s', ex)
+
+    def remove(self, key):
+        try:
+            connection = self._connection()
+            with connection:
+                connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+        except sqlite3.Error as ex:
+            log.warning('Shared cache write failed: %s', ex)
+
+    def _connection(self):
+        # SQLite connections are used by the thread that opened them only
+        connection = getattr(self._local, 'connection', None)
+        if (connection is None):
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            # write ahead logging lets readers in other processes go on while one writes
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
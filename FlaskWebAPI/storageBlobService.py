@@ -1,12 +1,333 @@
+import bisect
 import io
+import itertools
+import logging
 import os
 import random
+import threading
 import time
 import uuid
+from collections import OrderedDict
 
-from azure.storage.blob import (
-    BlockBlobService
-)
+import httpTransport
+import jsonCodec
+import metrics
+
+# how long (seconds) the parsed task list is served from memory before the blob ETag
+# is checked again. Can be overridden through the STORAGE_CACHE_TTL environment variable
+CACHE_TTL_SECONDS = 5
+
+# storage layouts. 'single' keeps every task in one JSON array blob (the original format),
+# 'sharded' stores each task in its own blob plus a small index blob used for listing and
+# for allocating the next id, 'log' keeps a snapshot blob plus an append blob of the 
+# changes made since (JSON lines), see _read_log_tasks. Selected through the 
+# STORAGE_LAYOUT environment variable
+LAYOUT_SINGLE = 'single'
+LAYOUT_SHARDED = 'sharded'
+LAYOUT_LOG = 'log'
+
+# in the log layout, a log that has grown past this many bytes is compacted into a new 
+# snapshot in the background. STORAGE_LOG_COMPACT_BYTES overrides it
+LOG_COMPACT_BYTES = 1024 * 1024
+
+# the sharded layout reads the task blobs of a list concurrently, on up to this many 
+# threads (and pooled connections). STORAGE_SHARD_READ_THREADS overrides it
+SHARD_READ_THREADS = 16
+
+# conditional writes that lose against another writer are retried on a fresh read this 
+# many times, with a jittered exponential backoff starting at WRITE_RETRY_BACKOFF seconds
+MAX_WRITE_RETRIES = 8
+WRITE_RETRY_BACKOFF = 0.02
+
+# task lists with at least this many tasks are serialized straight into a block upload
+# instead of being built as one string first. STORAGE_STREAM_THRESHOLD overrides it
+STREAM_THRESHOLD = 5000
+# streamed lists are serialized this many tasks per chunk, few enough to keep the chunks 
+# small and enough that the per chunk overhead of the upload or the response does not count
+STREAM_CHUNK_TASKS = 200
+
+# where the blobs are kept. 'azure' is the storage account, whose key comes from the Key 
+# Vault; 'local' (a directory, STORAGE_LOCAL_PATH) and 'memory' need no key, see 
+# localBlobService. Selected through the STORAGE_BACKEND environment variable
+BACKEND_AZURE = 'azure'
+BACKEND_LOCAL = 'local'
+BACKEND_MEMORY = 'memory'
+LOCAL_PATH = 'localstorage'
+
+# every change of the single blob and log layouts gets the next revision of the list, deleted 
+# tasks are remembered (id and revision) for the change feed, see get_changes. Beyond 
+# this many the oldest deletions are dropped and clients polling from before them get 
+# the complete list again
+MAX_TOMBSTONES = 10000
+
+# operations of a batch, see apply_batch
+OP_CREATE = 'create'
+OP_UPDATE = 'update'
+OP_DELETE = 'delete'
+
+log = logging.getLogger(__name__)
+
+class TaskNotFoundError(Exception):
+    def __init__(self, task_id):
+        super().__init__('Task not found: {0}'.format(task_id))
+        self.task_id = task_id
+
+class WriteConflictError(Exception):
+    def __init__(self, blob_name):
+        super().__init__('Too many concurrent updates of blob: ' + blob_name)
+
+def _is_status(ex, status_code):
+    # AzureHttpError and friends carry the HTTP status of the failed call
+    return getattr(ex, 'status_code', None) == status_code
+
+def _backoff(attempt):
+    time.sleep(WRITE_RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+def iter_json_array(items, chunk_items=STREAM_CHUNK_TASKS):
+    """
+    Serializes an iterable to a JSON array piece by piece, chunk_items items at a time
+    """
+    items = iter(items)
+    yield '['
+    separator = ''
+    while True:
+        chunk = list(itertools.islice(items, chunk_items))
+        if (len(chunk) == 0):
+            break
+        # the array of the chunk without its brackets
+        yield separator + jsonCodec.dumps(chunk)[1:-1]
+        separator = ', '
+    yield ']'
+
+class TaskTable(OrderedDict):
+    """
+    The tasks of the single blob and log layouts, keyed by id in blob order, with the 
+    revision of the list and the deletions (id -> revision) newer than pruned_rev. 
+    Mutations work on next_version(), which keeps only their changes, see TaskChanges. 
+    The changes are applied with apply_record: to a copy that the single blob layout 
+    uploads, or in place to the cached table of the log layout.
+    """
+    def __init__(self, tasks=(), rev=0, deleted=None, pruned_rev=0):
+        super().__init__(tasks)
+        self.rev = rev
+        self.deleted = OrderedDict() if (deleted is None) else deleted
+        self.pruned_rev = pruned_rev
+
+    def copy(self):
+        return TaskTable(self, self.rev, OrderedDict(self.deleted), self.pruned_rev)
+
+    def next_version(self):
+        return TaskChanges(self)
+
+    def apply_record(self, record):
+        """
+        Replays a change record, as listed in TaskChanges.changes and in the log layout
+        """
+        if ('put' in record):
+            self._put(record['put'])
+            self.rev = max(self.rev, record['put']['rev'])
+        else:
+            self.pop(record['del'], None)
+            self._remove(record['del'], record['rev'])
+            self.rev = max(self.rev, record['rev'])
+
+    def _put(self, task):
+        self.deleted.pop(task['id'], None)
+        self[task['id']] = task
+
+    def _remove(self, task_id, rev):
+        self.pop(task_id, None)
+        self.deleted[task_id] = rev
+        while (len(self.deleted) > MAX_TOMBSTONES):
+            pruned_id, pruned_rev = self.deleted.popitem(last=False)
+            self.pruned_rev = max(self.pruned_rev, pruned_rev)
+
+class TaskChanges(object):
+    """
+    The next version of a TaskTable, kept as the changes made to it: reads see the table 
+    with the changes, put and remove add to them and give the records the next revision. 
+    The changes are listed as log records in 'changes'. The table must not change while 
+    the mutations run (see _apply_mutations). Costs the number of changes, not the number 
+    of tasks.
+    """
+    def __init__(self, base):
+        self.base = base
+        self.rev = base.rev + 1
+        self.changes = []
+        self._tasks = {}                # id -> task put, or None when removed
+        self._added = OrderedDict()     # ids put that go at the end, in the order they were put
+
+    def __contains__(self, task_id):
+        return self.get(task_id) is not None
+
+    def __getitem__(self, task_id):
+        task = self.get(task_id)
+        if (task is None):
+            raise KeyError(task_id)
+        return task
+
+    def get(self, task_id, default=None):
+        task = self._tasks[task_id] if (task_id in self._tasks) else self.base.get(task_id)
+        return default if (task is None) else task
+
+    def __len__(self):
+        count = len(self.base)
+        for task_id, task in self._tasks.items():
+            if (task_id in self.base):
+                count -= (task is None)
+            else:
+                count += (task is not None)
+        return count
+
+    def __reversed__(self):
+        for task_id in reversed(self._added):
+            yield task_id
+        for task_id in reversed(self.base):
+            if (task_id not in self._added and self._tasks.get(task_id, task_id) is not None):
+                yield task_id
+
+    def put(self, task):
+        # a task that is not there goes at the end, like in the table
+        if (task['id'] not in self):
+            self._added[task['id']] = True
+        task['rev'] = self.rev
+        self._tasks[task['id']] = task
+        self.changes.append({'put': task})
+
+    def remove(self, task_id):
+        self._added.pop(task_id, None)
+        self._tasks[task_id] = None
+        self.changes.append({'del': task_id, 'rev': self.rev})
+
+    def table(self):
+        """
+        Returns the next version as a TaskTable of its own, a copy of the table
+        """
+        table = self.base.copy()
+        for record in self.changes:
+            table.apply_record(record)
+        table.rev = self.rev
+        return table
+
+def _decode_task_blob(content):
+    if (not content):
+        return []
+    with metrics.span('json_parse'):
+        return jsonCodec.decode_task_blob(content)
+
+def _task_table(content):
+    return _table_from_decoded(_decode_task_blob(content))
+
+def _table_from_decoded(decoded):
+    if (isinstance(decoded, list)):
+        # written before revisions existed, those tasks are all revision 1
+        for task in decoded:
+            task.setdefault('rev', 1)
+        return TaskTable(((task['id'], task) for task in decoded), 1 if decoded else 0)
+    return TaskTable(((task['id'], task) for task in decoded['tasks']), decoded['rev'], 
+                     OrderedDict((task_id, rev) for task_id, rev in decoded['deleted']), 
+                     decoded['pruned_rev'])
+
+def iter_task_document(tasks, generation=None):
+    """
+    Serializes a TaskTable to the task list blob format piece by piece. generation is 
+    set for the snapshot of the log layout only.
+    """
+    if (generation is not None):
+        yield '{{"generation": {0}, '.format(generation)
+    else:
+        yield '{'
+    yield '"rev": {0}, "pruned_rev": {1}, "deleted": {2}, "tasks": '.format(
+        tasks.rev, tasks.pruned_rev, jsonCodec.dumps([[task_id, rev] for task_id, rev in tasks.deleted.items()]))
+    for chunk in iter_json_array(tasks.values()):
+        yield chunk
+    yield '}'
+
+def _log_etag(generation, offset):
+    return '"{0}-{1}"'.format(generation, offset)
+
+def _parse_log_etag(etag):
+    generation, offset = etag.strip('"').split('-')
+    return int(generation), int(offset)
+
+class _TextChunkStream(io.RawIOBase):
+    """
+    Read-only, non seekable stream over text chunks produced by a generator, encoded as 
+    utf-8 on demand. Lets serialization feed straight into create_blob_from_stream.
+    """
+    def __init__(self, chunks):
+        self._chunks = chunks
+        # what is left of the last chunk, encoded chunks are copied straight into the reader's buffer
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        count = 0
+        while (count < len(view)):
+            if (len(self._buffer) == 0):
+                chunk = next(self._chunks, None)
+                if (chunk is None):
+                    break
+                self._buffer = chunk.encode('utf-8')
+            taken = min(len(view) - count, len(self._buffer))
+            view[count:count + taken] = self._buffer[:taken]
+            self._buffer = self._buffer[taken:]
+            count += taken
+        return count
+
+class _PendingMutation():
+    def __init__(self, mutation):
+        self.mutation = mutation
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class _WriteCoalescer():
+    """
+    Batches mutations that arrive within a short window into one read-modify-write. The 
+    first caller of a window waits for the window to pass and applies the whole batch, 
+    the others wait for their result. Batches of different windows are not serialized 
+    against each other; they rely on the conditional write like any other writer.
+    """
+    def __init__(self, apply_mutations, window_seconds):
+        self.apply_mutations = apply_mutations
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._pending = []
+        self._leader_waiting = False
+
+    def submit(self, mutation):
+        item = _PendingMutation(mutation)
+        with self._lock:
+            self._pending.append(item)
+            leader = not self._leader_waiting
+            self._leader_waiting = True
+
+        if (leader):
+            time.sleep(self.window_seconds)
+            with self._lock:
+                batch = self._pending
+                self._pending = []
+                self._leader_waiting = False
+            try:
+                outcomes = self.apply_mutations([pending.mutation for pending in batch])
+                for pending, (result, error) in zip(batch, outcomes):
+                    pending.result = result
+                    pending.error = error
+            except Exception as ex:
+                for pending in batch:
+                    pending.error = ex
+            finally:
+                for pending in batch:
+                    pending.done.set()
+
+        item.done.wait()
+        if (item.error is not None):
+            raise item.error
+        return item.result
 
 class StorageBlobServiceWrapper():
     """
@@ -15,20 +336,92 @@ class StorageBlobServiceWrapper():
     object is created and can be used to access the blob items 
     """
 
-    def __init__(self, account_name): 
+    def __init__(self, account_name, cache_ttl_seconds=None, layout=None, coalesce_window_seconds=None, 
+                 backend=None): 
         self.account_name=account_name
         self.account_key=None 
         self.service = None 
+        self.backend = backend or os.environ.get('STORAGE_BACKEND', BACKEND_AZURE)
+        if (self.backend == BACKEND_LOCAL):
+            from localBlobService import LocalBlobService
+            self.service = LocalBlobService(os.environ.get('STORAGE_LOCAL_PATH', LOCAL_PATH), 
+                                            use_mmap=(os.environ.get('STORAGE_LOCAL_MMAP', '0') == '1'),
+                                            fsync=(os.environ.get('STORAGE_LOCAL_FSYNC', '0') == '1'))
+        elif (self.backend == BACKEND_MEMORY):
+            from localBlobService import MemoryBlobService
+            self.service = MemoryBlobService()
+        elif (self.backend != BACKEND_AZURE):
+            raise ValueError('Unknown storage backend: ' + self.backend)
+        # append blob operations of the log layout, the local backends do both
+        self.append_service = self.service
 
         self.container_name = 'listcontainer'
         self.blob_name = 'listblob'
+        self.index_blob_name = 'listindex'
+        self.task_blob_prefix = 'tasks/'
+        self.snapshot_blob_name = 'listsnapshot'
+        self.log_blob_prefix = 'listlog/'
+        self.layout = layout or os.environ.get('STORAGE_LAYOUT', LAYOUT_SINGLE)
+        if (self.layout not in (LAYOUT_SINGLE, LAYOUT_SHARDED, LAYOUT_LOG)):
+            raise ValueError('Unknown storage layout: ' + self.layout)
+        self.log_compact_bytes = int(os.environ.get('STORAGE_LOG_COMPACT_BYTES', LOG_COMPACT_BYTES))
+        self.shard_read_threads = int(os.environ.get('STORAGE_SHARD_READ_THREADS', SHARD_READ_THREADS))
+        self._shard_reader = None
+        self._compacting = False
         # our flag to ensure that the container and blobs are already created
         self._container_blob_created = False
+
+        # in-process cache of the parsed task list, revalidated against the blob ETag
+        if (cache_ttl_seconds is None):
+            cache_ttl_seconds = float(os.environ.get('STORAGE_CACHE_TTL', CACHE_TTL_SECONDS))
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self._cache_lock = threading.Lock()
+        self._cached_tasks = None
+        self._cached_etag = None
+        self._cached_time = 0
+        # precomputed orderings of the cached tasks, per 'done' filter, see get_tasks_page
+        self._views_source = None
+        self._views = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._write_conflicts = 0
+
+        # optional write coalescing: mutations arriving within the window share one blob write
+        if (coalesce_window_seconds is None):
+            coalesce_window_seconds = float(os.environ.get('STORAGE_COALESCE_WINDOW', 0))
+        self.stream_threshold = int(os.environ.get('STORAGE_STREAM_THRESHOLD', STREAM_THRESHOLD))
+        self._coalescer = None
+        if (coalesce_window_seconds > 0 and self.layout != LAYOUT_SHARDED):
+            self._coalescer = _WriteCoalescer(self._apply_mutations, coalesce_window_seconds)
         return
 
+    def needs_storageKey(self):
+        """
+        True until the account key has been set, and only for the Azure storage backend
+        """
+        return self.service is None
+
     def set_storageKey(self,storageKey):
+        # the storage SDK is heavy to import, so it is loaded only once there is a key
+        from azure.storage.blob import BlockBlobService
         self.account_key=storageKey
-        self.service = BlockBlobService(account_name= self.account_name, account_key=self.account_key)
+        # enough pooled connections for the concurrent reads of the sharded layout
+        self.service = BlockBlobService(account_name= self.account_name, account_key=self.account_key, 
+                                        request_session=httpTransport.new_session(max(self.shard_read_threads, 1)))
+        self.append_service = self.service
+        if (self.layout == LAYOUT_LOG):
+            from azure.storage.blob import AppendBlobService
+            self.append_service = AppendBlobService(account_name= self.account_name, account_key=self.account_key)
+
+    def prewarm(self):
+        """
+        creates/checks the container and blobs and loads the task list into the cache
+        """
+        self._check_create_container_blob()
+        if (self.layout == LAYOUT_SHARDED):
+            self._get_index()
+        else:
+            self._read_blob_tasks()
 
     def get_blob_content(self):
         self._check_create_container_blob()
@@ -36,19 +429,812 @@ class StorageBlobServiceWrapper():
         content = blob.content 
         return content
 
+    def get_blob_tasks(self):
+        """
+        Returns the parsed task list. Within the cache TTL the list is served straight from 
+        memory; after that the blob ETag is checked and the blob is downloaded and parsed 
+        again only if it has changed. Callers get their own copy of the task records. Single 
+        blob and log layouts only, see get_tasks.
+        """
+        tasks, etag = self._read_blob_tasks()
+        view = self._get_view(tasks, None)
+        if (len(view) == 0):
+            return None
+        return [dict(task) for task in view]
+
+    def _read_blob_tasks(self, revalidate=False):
+        """
+        Returns the tasks as a TaskTable (an OrderedDict keyed by id, in blob order), together 
+        with the ETag it was read at. With revalidate the TTL is ignored and the ETag is always checked 
+        against the blob. The returned dict and its records are shared with the cache and 
+        must not be modified.
+        """
+        if (self.layout == LAYOUT_SHARDED):
+            raise ValueError('The sharded layout keeps no task list blob')
+        self._check_create_container_blob()
+        if (self.layout == LAYOUT_LOG):
+            return self._read_log_tasks(revalidate)
+        # blob I/O happens outside the lock so concurrent requests are not serialized on it
+        with self._cache_lock:
+            cached_tasks, cached_etag, cached_time = self._cached_tasks, self._cached_etag, self._cached_time
+        if (cached_etag is not None):
+            if ((not revalidate) and (time.time() - cached_time) < self.cache_ttl_seconds):
+                self._count(hits=1)
+                return cached_tasks, cached_etag
+            with metrics.span('storage_read'):
+                blob = self.service.get_blob_properties(self.container_name, self.blob_name)
+            if (blob.properties.etag == cached_etag):
+                with self._cache_lock:
+                    if (self._cached_etag == cached_etag):
+                        self._cached_time = time.time()
+                    self.cache_hits += 1
+                return cached_tasks, cached_etag
+
+        with metrics.span('storage_read'):
+            blob = self.service.get_blob_to_text(self.container_name, self.blob_name)
+        tasks = _task_table(blob.content)
+        with self._cache_lock:
+            self.cache_misses += 1
+            self._cached_tasks = tasks
+            self._cached_etag = blob.properties.etag
+            self._cached_time = time.time()
+        return tasks, blob.properties.etag
+
+    def get_cache_stats(self):
+        with self._cache_lock:
+            return {'hits': self.cache_hits, 'misses': self.cache_misses, 'write_conflicts': self._write_conflicts}
+
+    def _count(self, hits=0, misses=0, write_conflicts=0):
+        # the counters are updated by many request threads at once
+        with self._cache_lock:
+            self.cache_hits += hits
+            self.cache_misses += misses
+            self._write_conflicts += write_conflicts
+
+    def invalidate_cache(self):
+        with self._cache_lock:
+            self._cached_tasks = None
+            self._cached_etag = None
+
     def update_blob_content(self, txtcontent):
+        """
+        Uploads the text and returns the upload response properties (etag, last_modified). 
+        Nothing is downloaded back. 
+        """
+        self._check_create_container_blob()
+        properties = self.service.create_blob_from_text(self.container_name, self.blob_name, txtcontent)
+        self.invalidate_cache()
+        return properties
+
+    def update_blob_tasks(self, tasks, if_match=None):
+        """
+        Serializes and uploads the task list. As we know exactly what was written, the cache 
+        is primed with it under the ETag returned by the upload. With if_match the upload 
+        only succeeds if the blob still has that ETag (HTTP 412 otherwise). The list is 
+        replaced as a whole, so the change feed starts over: clients polling with an older 
+        revision get the complete list. In the log layout the list becomes the snapshot of 
+        a new log generation, see _replace_log_tasks; if_match is then an ETag of that 
+        layout and a mismatch raises WriteConflictError. The sharded layout has no such list 
+        and raises ValueError.
+        """
+        if (self.layout == LAYOUT_SHARDED):
+            raise ValueError('The sharded layout keeps no task list blob')
+        rev = max([task.get('rev', 0) for task in tasks] + [0]) + 1
+        table = TaskTable(rev=rev, pruned_rev=rev)
+        for task in tasks:
+            table[task['id']] = dict(task, rev=task.get('rev', rev))
+        if (self.layout == LAYOUT_LOG):
+            return self._replace_log_tasks(table, if_match)
+        if (self.layout == LAYOUT_SINGLE):
+            # revisions keep growing, for the clients of the change feed
+            current, etag = self._read_blob_tasks(revalidate=True)
+            table.rev = table.pruned_rev = max(table.rev, current.rev + 1)
+        return self._write_blob_tasks(table, if_match)
+
+    def _write_blob_tasks(self, tasks, if_match=None):
+        # tasks is a TaskTable, it becomes the cached copy so it must not be modified afterwards
         self._check_create_container_blob()
-        self.service.create_blob_from_text(self.container_name, self.blob_name, txtcontent)
+        properties = self._upload_task_document(self.blob_name, tasks, if_match=if_match)
+        with self._cache_lock:
+            self._cached_tasks = tasks
+            self._cached_etag = properties.etag
+            self._cached_time = time.time()
+        return properties
+
+    def _upload_task_document(self, blob_name, tasks, generation=None, if_match=None, if_none_match=None):
+        with metrics.span('storage_write'):
+            if (len(tasks) >= self.stream_threshold):
+                stream = _TextChunkStream(iter_task_document(tasks, generation))
+                return self.service.create_blob_from_stream(self.container_name, blob_name, 
+                                                            stream, max_connections=1, 
+                                                            if_match=if_match, if_none_match=if_none_match)
+            return self.service.create_blob_from_text(self.container_name, blob_name, 
+                                                      ''.join(iter_task_document(tasks, generation)), 
+                                                      if_match=if_match, if_none_match=if_none_match)
+
+    # Log layout. The snapshot blob holds the task list as of the start of a log generation 
+    # and the number of that generation; the append blob 'listlog/<generation>' holds one 
+    # JSON line per change made since (see TaskChanges.changes). A mutation appends its lines 
+    # at the end of the log as this process last read it (appendpos_condition), so it 
+    # costs one small write and fails with 412 when another writer appended first. Readers 
+    # keep the table and their position in the log, and only read what was appended since. 
+    # Compaction appends a 'sealed' line, which stops all further appends to that log, then 
+    # creates the next generation's log and writes the new snapshot. Any process finding a 
+    # sealed log that the snapshot still points to finishes the compaction, so a compaction 
+    # that is interrupted half way does not block the writers.
+
+    def _log_blob_name(self, generation):
+        return '{0}{1}'.format(self.log_blob_prefix, generation)
+
+    def _read_log_tasks(self, revalidate=False):
+        # the ETag of this layout is the log generation and the position read up to
+        with self._cache_lock:
+            cached_tasks, cached_etag, cached_time = self._cached_tasks, self._cached_etag, self._cached_time
+        if (cached_etag is not None):
+            if ((not revalidate) and (time.time() - cached_time) < self.cache_ttl_seconds):
+                self._count(hits=1)
+                return cached_tasks, cached_etag
+            generation, offset = _parse_log_etag(cached_etag)
+            records, end, sealed = self._read_log_records(generation, offset)
+            if (not sealed):
+                etag = _log_etag(generation, end)
+                if (len(records) == 0):
+                    with self._cache_lock:
+                        self.cache_hits += 1
+                        if (self._cached_etag == cached_etag):
+                            self._cached_time = time.time()
+                    return cached_tasks, etag
+                self._count(misses=1)
+                if (self._advance_cache(cached_tasks, cached_etag, records, etag)):
+                    return cached_tasks, etag
+                # another thread got there first, the cache is as new as this read if it 
+                # applied the same records
+                with self._cache_lock:
+                    current_tasks, current_etag = self._cached_tasks, self._cached_etag
+                if (current_etag is not None):
+                    current_generation, current_offset = _parse_log_etag(current_etag)
+                    if (current_generation == generation and current_offset >= end):
+                        return current_tasks, current_etag
+
+        tasks, etag = self._load_log()
+        with self._cache_lock:
+            self.cache_misses += 1
+            self._cached_tasks = tasks
+            self._cached_etag = etag
+            self._cached_time = time.time()
+        return tasks, etag
+
+    def _advance_cache(self, tasks, etag, records, end_etag):
+        """
+        Applies change records read from (or appended to) the log at etag to the cached 
+        tasks in place, if they still are the cached tasks at etag. Returns whether they were. 
+        Readers list the cached tasks under the lock (see _get_view), lookups see each 
+        record replaced as a whole.
+        """
+        with self._cache_lock:
+            if (self._cached_tasks is not tasks or self._cached_etag != etag):
+                return False
+            for record in records:
+                tasks.apply_record(record)
+            self._cached_etag = end_etag
+            self._cached_time = time.time()
+            # the views and the change log are built again when next asked for
+            self._views_source = None
+            self._views = {}
+        return True
+
+    def _load_log(self):
+        """
+        Reads the snapshot and replays its log, returns the tasks and the log ETag
+        """
+        for attempt in range(MAX_WRITE_RETRIES):
+            snapshot, tasks, generation = self._read_snapshot()
+            records, end, sealed = self._read_log_records(generation, 0)
+            for record in records:
+                tasks.apply_record(record)
+            if (not sealed):
+                return tasks, _log_etag(generation, end)
+            # a compaction of this generation has started, make sure it completes
+            self._finish_compaction(tasks, generation, snapshot.properties.etag)
+            _backoff(attempt)
+        raise WriteConflictError(self.snapshot_blob_name)
+
+    def _read_snapshot(self):
+        with metrics.span('storage_read'):
+            snapshot = self.service.get_blob_to_text(self.container_name, self.snapshot_blob_name)
+        decoded = _decode_task_blob(snapshot.content)
+        return snapshot, _table_from_decoded(decoded), decoded['generation']
+
+    def _read_log_records(self, generation, offset):
+        """
+        Returns the change records appended to the log from offset on, the offset after the 
+        last complete record and whether the log is sealed (or already removed)
+        """
+        try:
+            with metrics.span('storage_read'):
+                blob = self.service.get_blob_to_bytes(self.container_name, self._log_blob_name(generation), 
+                                                      start_range=offset)
+        except Exception as ex:
+            if (_is_status(ex, 416)):
+                return [], offset, False        # nothing appended since
+            if (_is_status(ex, 404)):
+                return [], offset, True         # compacted and removed
+            raise
+        # an append may be in progress, only complete lines count
+        content = blob.content[:blob.content.rfind(b'\n') + 1]
+        records = []
+        with metrics.span('json_parse'):
+            for line in content.splitlines():
+                if (not line):
+                    continue
+                record = jsonCodec.loads(line)
+                if ('sealed' in record):
+                    return records, offset + len(content), True
+                records.append(record)
+        return records, offset + len(content), False
+
+    def _append_log(self, changes, etag):
+        """
+        Appends changes, the TaskChanges of the table read at etag, to the log and applies 
+        them to the cached table. Fails with 412 if the log has grown since etag, or with 404 
+        if it has since been compacted and removed.
+        """
+        generation, offset = _parse_log_etag(etag)
+        block = b''.join(jsonCodec.dumps_bytes(record) + b'\n' for record in changes.changes)
+        with metrics.span('storage_write'):
+            self.append_service.append_block(self.container_name, self._log_blob_name(generation), block, 
+                                             appendpos_condition=offset)
+        end = offset + len(block)
+        if (not self._advance_cache(changes.base, etag, changes.changes, _log_etag(generation, end))):
+            # the cache was replaced meanwhile, have the next read catch up with the log
+            with self._cache_lock:
+                self._cached_time = 0
+        if (end >= self.log_compact_bytes):
+            self._start_compaction()
+
+    def _start_compaction(self):
+        with self._cache_lock:
+            if (self._compacting):
+                return
+            self._compacting = True
+        compactor = threading.Thread(target=self._background_compaction)
+        compactor.daemon = True
+        compactor.start()
+
+    def _background_compaction(self):
+        try:
+            self.compact_log()
+        except Exception as ex:
+            log.warning('Compacting the task log failed: %s', ex)
+        finally:
+            with self._cache_lock:
+                self._compacting = False
+
+    def _replace_log_tasks(self, tasks, if_match=None):
+        """
+        Replaces the task list of the log layout the way compact_log does, with tasks instead 
+        of the replayed log: seals the current log and writes tasks as the snapshot of the 
+        next generation. Returns the properties of the snapshot upload.
+        """
+        self._check_create_container_blob()
+        for attempt in range(MAX_WRITE_RETRIES):
+            snapshot, current, generation = self._read_snapshot()
+            records, end, sealed = self._read_log_records(generation, 0)
+            for record in records:
+                current.apply_record(record)
+            if (sealed):
+                # a compaction of this generation has started, complete it and go on from the next
+                self._finish_compaction(current, generation, snapshot.properties.etag)
+                continue
+            if (if_match is not None and if_match != _log_etag(generation, end)):
+                raise WriteConflictError(self.snapshot_blob_name)
+            # revisions keep growing, for the clients of the change feed
+            tasks.rev = tasks.pruned_rev = max(tasks.rev, current.rev + 1)
+            seal = jsonCodec.dumps_bytes({'sealed': generation + 1}) + b'\n'
+            try:
+                self.append_service.append_block(self.container_name, self._log_blob_name(generation), seal, 
+                                                 appendpos_condition=end)
+            except Exception as ex:
+                if (not (_is_status(ex, 412) or _is_status(ex, 404))):
+                    raise
+                self._count(write_conflicts=1)
+                _backoff(attempt)
+                continue
+            properties = self._finish_compaction(tasks, generation, snapshot.properties.etag)
+            if (properties is None):
+                # another process completed the compaction first, with the log content
+                self._count(write_conflicts=1)
+                _backoff(attempt)
+                continue
+            with self._cache_lock:
+                self._cached_tasks = tasks
+                self._cached_etag = _log_etag(generation + 1, 0)
+                self._cached_time = time.time()
+            return properties
+        raise WriteConflictError(self.snapshot_blob_name)
+
+    def compact_log(self):
+        """
+        Writes a new snapshot of the log layout and starts a new, empty log. Returns False 
+        when a writer appended to the log while it was being read; it is then tried again 
+        after the next append past the threshold.
+        """
+        snapshot, tasks, generation = self._read_snapshot()
+        records, end, sealed = self._read_log_records(generation, 0)
+        for record in records:
+            tasks.apply_record(record)
+        if (not sealed):
+            seal = jsonCodec.dumps_bytes({'sealed': generation + 1}) + b'\n'
+            try:
+                self.append_service.append_block(self.container_name, self._log_blob_name(generation), seal, 
+                                                 appendpos_condition=end)
+            except Exception as ex:
+                # 404: another process compacted it and removed the log meanwhile
+                if (_is_status(ex, 412) or _is_status(ex, 404)):
+                    return False
+                raise
+        self._finish_compaction(tasks, generation, snapshot.properties.etag)
+        return True
+
+    def _finish_compaction(self, tasks, generation, snapshot_etag):
+        # tasks is the content of the sealed log 'generation' replayed on its snapshot, or 
+        # the list replacing it. Returns the properties of the new snapshot, or None when 
+        # another process wrote it first
+        try:
+            self.append_service.create_blob(self.container_name, self._log_blob_name(generation + 1), 
+                                            if_none_match='*')
+        except Exception as ex:
+            if (not _is_status(ex, 409)):
+                raise
+        try:
+            properties = self._upload_task_document(self.snapshot_blob_name, tasks, generation + 1, if_match=snapshot_etag)
+        except Exception as ex:
+            # 412: another process finished it
+            if (not _is_status(ex, 412)):
+                raise
+            return None
+        try:
+            self.service.delete_blob(self.container_name, self._log_blob_name(generation))
+        except Exception as ex:
+            if (not _is_status(ex, 404)):
+                raise
+        return properties
+
+    # Task level operations, used by the Web API handlers. These hide the storage layout. 
+    # All mutations are conditional writes against the ETag they were computed from, and
+    # are retried on a fresh read when another writer got there first.
+    # In the single blob and log layouts the tasks are kept in a TaskTable keyed by id, so 
+    # lookups, updates and deletes do not scan the list.
+
+    def get_tasks(self):
+        if (self.layout == LAYOUT_SHARDED):
+            index, etag = self._get_index()
+            return self._get_task_blobs(index['ids'])
+        return self.get_blob_tasks() or []
+
+    def get_tasks_page(self, offset=0, limit=None, done=None):
+        """
+        Returns (tasks, total): at most limit tasks starting at offset, in list order (the 
+        order they were created in, not sorted), optionally only those whose 'done' equals the 
+        given value. total is the number of tasks matching the filter. Only the returned 
+        records are copied.
+        """
+        tasks, total = self.iter_tasks_page(offset, limit, done)
+        return [dict(task) for task in tasks], total
+
+    def iter_tasks_page(self, offset=0, limit=None, done=None):
+        """
+        Same as get_tasks_page, but returns an iterator over the records instead of a list 
+        of copies, for serializing them one at a time. The records must not be modified.
+        """
+        end = None if (limit is None) else offset + limit
+        if (self.layout == LAYOUT_SHARDED):
+            index, etag = self._get_index()
+            if (done is None):
+                return iter(self._get_task_blobs(index['ids'][offset:end])), len(index['ids'])
+            # the filter needs every task blob in this layout
+            view = [task for task in self._get_task_blobs(index['ids']) if task['done'] == done]
+            return iter(view[offset:end]), len(view)
+
+        tasks, etag = self._read_blob_tasks()
+        view = self._get_view(tasks, done)
+        return itertools.islice(view, offset, end), len(view)
+
+    def _get_view(self, tasks, done):
+        # views are built once per version of the cached tasks and then only sliced. The 
+        # tasks are listed under the lock, the log layout changes them in place
+        with self._cache_lock:
+            views = self._get_views(tasks)
+            listed = views.get(None)
+            if (listed is None):
+                listed = views[None] = list(tasks.values())
+            view = listed if (done is None) else views.get(done)
+        if (view is None):
+            view = [task for task in listed if task['done'] == done]
+            with self._cache_lock:
+                if (self._views is views):
+                    views[done] = view
+        return view
+
+    def _get_views(self, tasks):
+        # the views of tasks, called with the lock held. A new dict for every version
+        if (self._views_source is not tasks):
+            self._views_source = tasks
+            self._views = {}
+        return self._views
+
+    def get_list_version(self):
+        """
+        Returns (rev, etag) of the current task list, single blob and log layouts only. The ETag 
+        changes with every write of the blob, also those not made through this class.
+        """
+        tasks, etag = self._read_blob_tasks()
+        return tasks.rev, etag
+
+    def get_changes(self, since):
+        """
+        Change feed of the single blob and log layouts. Returns (rev, tasks, deleted, reset): the 
+        current revision, copies of the tasks created or updated after revision since, 
+        and the ids of the tasks deleted after it. When deletions that old are no longer 
+        known, reset is True and tasks is the complete list. The cost depends on the 
+        number of changes, not on the number of tasks.
+        """
+        tasks, etag = self._read_blob_tasks()
+        rev, pruned_rev, revs, changes = self._get_change_log(tasks)
+        if (since < pruned_rev):
+            # the list may be newer than rev, the client then gets those changes again
+            return rev, [dict(task) for task in self._get_view(tasks, None)], [], True
+        changed = []
+        deleted = []
+        for task_id, task in changes[bisect.bisect_right(revs, since):]:
+            if (task is None):
+                deleted.append(task_id)
+            else:
+                changed.append(dict(task))
+        return rev, changed, deleted, False
+
+    def _get_change_log(self, tasks):
+        # tasks and deletions ordered by revision, with the revisions they are complete for, 
+        # built once per version like the views
+        with self._cache_lock:
+            views = self._get_views(tasks)
+            log = views.get('changes')
+            if (log is None):
+                rev, pruned_rev = tasks.rev, tasks.pruned_rev
+                entries = [(task['rev'], task_id, task) for task_id, task in tasks.items()]
+                entries.extend((deleted_rev, task_id, None) for task_id, deleted_rev in tasks.deleted.items())
+        if (log is None):
+            entries.sort(key=lambda entry: entry[0])
+            log = (rev, pruned_rev, [entry[0] for entry in entries], [(entry[1], entry[2]) for entry in entries])
+            with self._cache_lock:
+                if (self._views is views):
+                    views['changes'] = log
+        return log
+
+    def get_task(self, task_id):
+        if (self.layout == LAYOUT_SHARDED):
+            self._check_create_container_blob()
+            return self._get_task_blob(task_id)[0]
+        tasks, etag = self._read_blob_tasks()
+        task = tasks.get(task_id)
+        if (task is None):
+            return None
+        return dict(task)
+
+    def create_task(self, title, description):
+        if (self.layout == LAYOUT_SHARDED):
+            return self._create_task_sharded(title, description)
+        return self._submit_mutation(self._create_mutation(title, description))
+
+    def update_task(self, task_id, title, description, done):
+        """
+        Updates the task and returns it, or None when the task does not exist
+        """
+        if (self.layout == LAYOUT_SHARDED):
+            return self._update_task_sharded(task_id, title, description, done)
+        return self._submit_mutation(self._update_mutation(task_id, title, description, done))
+
+    def delete_task(self, task_id):
+        """
+        Deletes the task, returns False when the task does not exist
+        """
+        if (self.layout == LAYOUT_SHARDED):
+            return self._delete_task_sharded(task_id)
+        return self._submit_mutation(self._delete_mutation(task_id))
+
+    def apply_batch(self, operations, atomic=False):
+        """
+        Applies a list of operations, dicts with 'op' (OP_CREATE, OP_UPDATE or OP_DELETE) 
+        and the arguments of create_task/update_task/delete_task ('id', 'title', 
+        'description', 'done'), in order, with one read and one write of the task list. 
+        Returns a (result, error) pair per operation; error is TaskNotFoundError for an 
+        update or delete of a task that does not exist, a ValueError for an operation that 
+        cannot be applied and, in the sharded layout only, WriteConflictError. With atomic nothing is written 
+        unless every operation succeeds. The sharded layout applies the operations one by 
+        one and cannot do atomic batches.
+        """
+        if (self.layout == LAYOUT_SHARDED):
+            if (atomic):
+                raise ValueError('Atomic batches need the single blob or log layout')
+            return [self._apply_operation_sharded(operation) for operation in operations]
+
+        mutations = []
+        for operation in operations:
+            if (operation['op'] == OP_CREATE):
+                mutations.append(self._create_mutation(operation['title'], operation['description']))
+            elif (operation['op'] == OP_UPDATE):
+                mutations.append(self._update_mutation(operation['id'], operation['title'], 
+                                                       operation['description'], operation['done'], 
+                                                       missing=TaskNotFoundError))
+            elif (operation['op'] == OP_DELETE):
+                mutations.append(self._delete_mutation(operation['id'], missing=TaskNotFoundError))
+            else:
+                raise ValueError('Unknown batch operation: {0}'.format(operation['op']))
+        # already one write, so not handed to the write coalescer
+        return self._apply_mutations(mutations, atomic=atomic)
+
+    def _apply_operation_sharded(self, operation):
+        try:
+            if (operation['op'] == OP_CREATE):
+                return self._create_task_sharded(operation['title'], operation['description']), None
+            if (operation['op'] == OP_UPDATE):
+                task = self._update_task_sharded(operation['id'], operation['title'], 
+                                                 operation['description'], operation['done'])
+                if (task is None):
+                    return None, TaskNotFoundError(operation['id'])
+                return task, None
+            if (operation['op'] == OP_DELETE):
+                if (not self._delete_task_sharded(operation['id'])):
+                    return None, TaskNotFoundError(operation['id'])
+                return True, None
+            raise ValueError('Unknown batch operation: {0}'.format(operation['op']))
+        except (ValueError, WriteConflictError) as ex:
+            return None, ex
+
+    def _create_mutation(self, title, description):
+        def mutation(tasks):
+            if (len(tasks) == 0):
+                task = self._new_task(1, title, description)
+            else:
+                task = self._new_task(next(reversed(tasks)) + 1, title, description)
+            tasks.put(task)
+            return True, dict(task)
+        return mutation
+
+    def _update_mutation(self, task_id, title, description, done, missing=None):
+        # a task that does not exist gives the result None, or raises missing(task_id)
+        def mutation(tasks):
+            if (task_id not in tasks):
+                if (missing is not None):
+                    raise missing(task_id)
+                return False, None
+            # records are shared with the cache, so replace instead of editing in place
+            task = dict(tasks[task_id], title=title, description=description, done=done)
+            tasks.put(task)
+            return True, dict(task)
+        return mutation
+
+    def _delete_mutation(self, task_id, missing=None):
+        # a task that does not exist gives the result False, or raises missing(task_id)
+        def mutation(tasks):
+            if (task_id not in tasks):
+                if (missing is not None):
+                    raise missing(task_id)
+                return False, False
+            tasks.remove(task_id)
+            return True, True
+        return mutation
+
+    def _submit_mutation(self, mutation):
+        if (self._coalescer is not None):
+            return self._coalescer.submit(mutation)
+        result, error = self._apply_mutations([mutation])[0]
+        if (error is not None):
+            raise error
+        return result
+
+    def _apply_mutations(self, mutations, atomic=False):
+        """
+        Applies the mutations, in order, to one read of the task list and writes the result 
+        back with a single conditional upload. A mutation is a function taking the tasks as 
+        TaskChanges, changing them through put and remove (replacing records, never editing 
+        them) and returning (changed, result). Returns a (result, error) pair per mutation. 
+        With atomic, nothing is written if any mutation raised.
+        """
+        for attempt in range(MAX_WRITE_RETRIES):
+            # the first attempt may use the cached list, if it is stale the write fails
+            tasks, etag = self._read_blob_tasks(revalidate=(attempt > 0))
+            changes = tasks.next_version()
+            changed = False
+            outcomes = []
+            # under the lock, as the log layout changes the cached tasks in place
+            with self._cache_lock:
+                for mutation in mutations:
+                    try:
+                        bChanged, result = mutation(changes)
+                        changed = changed or bChanged
+                        outcomes.append((result, None))
+                    except Exception as ex:
+                        outcomes.append((None, ex))
+            if (not changed or (atomic and any(error is not None for result, error in outcomes))):
+                return outcomes
+            try:
+                if (self.layout == LAYOUT_LOG):
+                    self._append_log(changes, etag)
+                else:
+                    self._write_blob_tasks(changes.table(), if_match=etag)
+                return outcomes
+            except Exception as ex:
+                if (not (_is_status(ex, 412) or (self.layout == LAYOUT_LOG and _is_status(ex, 404)))):
+                    raise
+            self._count(write_conflicts=1)
+            _backoff(attempt)
+        raise WriteConflictError(self.blob_name)
+
+    def _create_task_sharded(self, title, description):
+        # the id is allocated by a conditional update of the index, the task blob follows
+        for attempt in range(MAX_WRITE_RETRIES):
+            index, etag = self._get_index()
+            task = self._new_task(index['next_id'], title, description)
+            index['next_id'] += 1
+            index['ids'].append(task['id'])
+            try:
+                self._put_index(index, if_match=etag)
+            except Exception as ex:
+                if (not _is_status(ex, 412)):
+                    raise
+                self._count(write_conflicts=1)
+                _backoff(attempt)
+                continue
+            self._put_task_blob(task)
+            return task
+        raise WriteConflictError(self.index_blob_name)
+
+    def _update_task_sharded(self, task_id, title, description, done):
+        self._check_create_container_blob()
+        for attempt in range(MAX_WRITE_RETRIES):
+            task, etag = self._get_task_blob(task_id)
+            if (task is None):
+                return None
+            task['title'] = title
+            task['description'] = description
+            task['done'] = done
+            try:
+                self._put_task_blob(task, if_match=etag)
+                return task
+            except Exception as ex:
+                # 404 here means it was deleted under us
+                if (_is_status(ex, 404)):
+                    return None
+                if (not _is_status(ex, 412)):
+                    raise
+            self._count(write_conflicts=1)
+            _backoff(attempt)
+        raise WriteConflictError(self._task_blob_name(task_id))
+
+    def _delete_task_sharded(self, task_id):
+        # the blob goes first: listing skips ids without a blob, but a blob whose id is no 
+        # longer in the index could still be read and updated
+        index, etag = self._get_index()
+        if (task_id not in index['ids']):
+            return False
+        deleted = True
+        try:
+            self.service.delete_blob(self.container_name, self._task_blob_name(task_id))
+        except Exception as ex:
+            if (not _is_status(ex, 404)):
+                raise
+            # deleted by another request, or an earlier delete that did not reach the index
+            deleted = False
+        for attempt in range(MAX_WRITE_RETRIES):
+            if (task_id not in index['ids']):
+                return deleted
+            index['ids'].remove(task_id)
+            try:
+                self._put_index(index, if_match=etag)
+                return deleted
+            except Exception as ex:
+                if (not _is_status(ex, 412)):
+                    raise
+            self._count(write_conflicts=1)
+            _backoff(attempt)
+            index, etag = self._get_index()
+        # the task is gone, only its id is left in the index; the next delete of it removes it
+        return deleted
+
+    def migrate_to_sharded(self):
+        """
+        One-shot migration of the legacy single 'listblob' array into per-task blobs and 
+        the index blob. The legacy blob is left in place untouched. Returns the number of 
+        tasks migrated.
+        """
         blob = self.service.get_blob_to_text(self.container_name, self.blob_name)
-        content = blob.content 
-        return content
+        tasks = list(_task_table(blob.content).values())
+        for task in tasks:
+            try:
+                self._put_task_blob(task, if_none_match='*')
+            except Exception as ex:
+                # written by an interrupted run, or by another process migrating at the same time
+                if (not _is_status(ex, 409)):
+                    raise
+        next_id = 1
+        if (len(tasks) > 0):
+            next_id = max(task['id'] for task in tasks) + 1
+        # index is written last, so an interrupted migration is simply run again; it is only 
+        # created, never replaced, as another process may have migrated and written since
+        self._put_index({'next_id': next_id, 'ids': [task['id'] for task in tasks]}, if_none_match='*')
+        return len(tasks)
+
+    def _new_task(self, task_id, title, description):
+        return {
+            'id': task_id,
+            'title': title,
+            'description': description,
+            'done': False
+        }
+
+    def _task_blob_name(self, task_id):
+        return '{0}{1}'.format(self.task_blob_prefix, task_id)
+
+    def _get_task_blob(self, task_id):
+        """
+        returns the task and the ETag of its blob, (None, None) when there is no such task
+        """
+        try:
+            with metrics.span('storage_read'):
+                blob = self.service.get_blob_to_text(self.container_name, self._task_blob_name(task_id))
+        except Exception as ex:
+            if (_is_status(ex, 404)):
+                return None, None
+            raise
+        return jsonCodec.loads(blob.content), blob.properties.etag
+
+    def _get_task_blobs(self, task_ids):
+        """
+        returns the tasks with these ids, in the same order, skipping those that no longer 
+        exist. The blobs are read concurrently.
+        """
+        if (len(task_ids) <= 1 or self.shard_read_threads <= 1):
+            tasks = [self._get_task_blob(task_id)[0] for task_id in task_ids]
+        else:
+            tasks = list(self._get_shard_reader().map(lambda task_id: self._get_task_blob(task_id)[0], task_ids))
+        return [task for task in tasks if task]
+
+    def _get_shard_reader(self):
+        with self._cache_lock:
+            if (self._shard_reader is None):
+                from concurrent.futures import ThreadPoolExecutor
+                self._shard_reader = ThreadPoolExecutor(max_workers=self.shard_read_threads, 
+                                                        thread_name_prefix='taskapi-shards')
+            return self._shard_reader
+
+    def _put_task_blob(self, task, if_match=None, if_none_match=None):
+        with metrics.span('storage_write'):
+            return self.service.create_blob_from_text(self.container_name, self._task_blob_name(task['id']), jsonCodec.dumps(task), 
+                                                      if_match=if_match, if_none_match=if_none_match)
+
+    def _get_index(self):
+        self._check_create_container_blob()
+        with metrics.span('storage_read'):
+            blob = self.service.get_blob_to_text(self.container_name, self.index_blob_name)
+        return jsonCodec.loads(blob.content), blob.properties.etag
+
+    def _put_index(self, index, if_match=None, if_none_match=None):
+        with metrics.span('storage_write'):
+            return self.service.create_blob_from_text(self.container_name, self.index_blob_name, jsonCodec.dumps(index), 
+                                                      if_match=if_match, if_none_match=if_none_match)
 
     def _check_create_container_blob(self):
         if (not self.service):
             return 
         if (not self._container_blob_created):
             self._container_exists_create()
-            self._blob_exists_create()
+            if (self.layout == LAYOUT_SHARDED):
+                self._index_exists_create()
+            elif (self.layout == LAYOUT_LOG):
+                self._snapshot_exists_create()
+            else:
+                self._blob_exists_create()
             self._container_blob_created = True
 
     def _container_exists_create(self):
@@ -61,12 +1247,49 @@ class StorageBlobServiceWrapper():
     def _blob_exists_create(self):
         exists = self.service.exists(self.container_name, self.blob_name) 
         if (exists == False):
-            # create an empty blob
-            self.service.create_blob_from_text(self.container_name, self.blob_name, u'')
+            # create an empty blob, unless another process created (and maybe wrote) it first
+            try:
+                self.service.create_blob_from_text(self.container_name, self.blob_name, u'', if_none_match='*')
+            except Exception as ex:
+                if (not _is_status(ex, 409)):
+                    raise
         exists = self.service.exists(self.container_name, self.blob_name)
         return exists
 
+    def _index_exists_create(self):
+        exists = self.service.exists(self.container_name, self.index_blob_name)
+        if (exists == False):
+            try:
+                if (self.service.exists(self.container_name, self.blob_name)):
+                    # first start in sharded mode over legacy data
+                    self.migrate_to_sharded()
+                else:
+                    self._put_index({'next_id': 1, 'ids': []}, if_none_match='*')
+            except Exception as ex:
+                # another process created it first
+                if (not _is_status(ex, 409)):
+                    raise
+        exists = self.service.exists(self.container_name, self.index_blob_name)
+        return exists
 
-
-   
-
+    def _snapshot_exists_create(self):
+        exists = self.service.exists(self.container_name, self.snapshot_blob_name)
+        if (exists == False):
+            tasks = TaskTable()
+            if (self.service.exists(self.container_name, self.blob_name)):
+                # first start in log mode over single blob data, which is left untouched
+                tasks = _task_table(self.service.get_blob_to_text(self.container_name, self.blob_name).content)
+            # the log exists before any snapshot points to it
+            try:
+                self.append_service.create_blob(self.container_name, self._log_blob_name(1), if_none_match='*')
+            except Exception as ex:
+                if (not _is_status(ex, 409)):
+                    raise
+            try:
+                self._upload_task_document(self.snapshot_blob_name, tasks, 1, if_none_match='*')
+            except Exception as ex:
+                # another process created it first
+                if (not _is_status(ex, 409)):
+                    raise
+        exists = self.service.exists(self.container_name, self.snapshot_blob_name)
+        return exists
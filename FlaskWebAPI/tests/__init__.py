@@ -0,0 +1,26 @@
+"""
+Tests of the Web API modules, run from the FlaskWebAPI directory with
+
+    python -m pytest tests        or        python -m unittest discover tests
+
+They use the in-memory storage backend and local stub servers, no Azure resources.
+appSecrets.py is not needed: without it a placeholder with made up values is used, also by
+benchmark.py.
+"""
+import sys
+import types
+
+try:
+    import appSecrets
+except ImportError:
+    sys.modules['appSecrets'] = types.SimpleNamespace(
+        ClientId='test-client-id',
+        ClientSecret='test-client-secret',
+        serviceIdentifierUri='api://test-service',
+        InstanceName='https://login.test.local/',
+        TenantId='test-tenant',
+        KV_VAULT_URL='https://vault.test.local/',
+        KV_Storage_AccountName='teststorage',
+        KV_Storage_AccountKeyName='test-storage-key',
+        KV_Storage_SECRET_VERSION='',
+    )
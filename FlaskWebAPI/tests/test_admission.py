@@ -0,0 +1,31 @@
+import unittest
+
+import admissionControl
+
+
+class TokenBucketLimiterTest(unittest.TestCase):
+    def test_burst_below_one(self):
+        # such a bucket never holds a whole token, every request would get 429
+        with self.assertRaises(ValueError):
+            admissionControl.TokenBucketLimiter(10, 0, 10)
+
+    def test_burst(self):
+        limiter = admissionControl.TokenBucketLimiter(1, 2, 10)
+        self.assertEqual(limiter.acquire('a'), 0)
+        self.assertEqual(limiter.acquire('a'), 0)
+        self.assertGreater(limiter.acquire('a'), 0)
+        self.assertEqual(limiter.acquire('b'), 0)
+        self.assertEqual(limiter.rejected, 1)
+
+    def test_max_keys(self):
+        # rejected keys are kept within max_keys too
+        limiter = admissionControl.TokenBucketLimiter(0.001, 1, 3)
+        for key in range(10):
+            self.assertEqual(limiter.acquire(key), 0)
+            self.assertGreater(limiter.acquire(key), 0)
+            self.assertLessEqual(len(limiter._buckets), 3)
+        self.assertEqual(list(limiter._buckets), [7, 8, 9])
+
+
+if __name__ == '__main__':
+    unittest.main()
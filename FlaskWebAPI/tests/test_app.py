@@ -0,0 +1,138 @@
+import os
+import unittest
+
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+import app
+import securityImpl
+import storageBlobService
+from localBlobService import MemoryBlobService
+
+API = '/todo/api/v1.0/tasks'
+
+
+class FakeSecurity(object):
+    """
+    Admits every request and counts the admission slots given back
+    """
+    def __init__(self):
+        self.storage = storageBlobService.StorageBlobServiceWrapper('test')
+        self.storage.service = self.storage.append_service = MemoryBlobService()
+        self.released = 0
+
+    def validateRequest(self, request):
+        return True, None
+
+    def get_StorageObject(self):
+        return self.storage
+
+    def release(self):
+        self.released += 1
+
+
+class ReleaseTest(unittest.TestCase):
+    """
+    The admission slot of a request is given back once: when the handler returns, or for a
+    streamed response when the server closes it
+    """
+    def setUp(self):
+        self.securityObj, self.threshold = app.securityObj, app.RESPONSE_STREAM_THRESHOLD
+        app.securityObj = self.security = FakeSecurity()
+        self.security.storage.create_task('one', '')
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        app.securityObj, app.RESPONSE_STREAM_THRESHOLD = self.securityObj, self.threshold
+
+    def test_streamed(self):
+        app.RESPONSE_STREAM_THRESHOLD = 0
+        response = self.client.get(API)
+        self.assertEqual(self.security.released, 0)
+        self.assertIn(b'"one"', response.get_data())
+        response.close()
+        self.assertEqual(self.security.released, 1)
+
+    def test_buffered(self):
+        response = self.client.get(API)
+        self.assertEqual(self.security.released, 1)
+        response.close()
+        self.assertEqual(self.security.released, 1)
+
+    def test_error(self):
+        response = self.client.get(API + '/99')
+        self.assertEqual(response.status_code, 404)
+        response.close()
+        self.assertEqual(self.security.released, 1)
+
+
+class TaskTypesTest(unittest.TestCase):
+    """
+    Values of the wrong type are rejected before they are written
+    """
+    def setUp(self):
+        self.securityObj = app.securityObj
+        app.securityObj = self.security = FakeSecurity()
+        self.security.storage.create_task('one', '')
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        app.securityObj = self.securityObj
+
+    def test_create(self):
+        for body in ({'title': 5}, {'title': 'two', 'description': None}, ['title']):
+            self.assertEqual(self.client.post(API, json=body).status_code, 400)
+
+    def test_update(self):
+        response = self.client.put(API + '/1', json={'title': 'x', 'description': 'd', 'done': 'yes'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.put(API + '/1', json={'title': 'x', 'description': 'd', 'done': True})
+        self.assertEqual(response.status_code, 200)
+
+    def test_batch(self):
+        for operation in ({'op': 'create', 'title': ['x']}, 
+                          {'op': 'update', 'id': 1, 'title': 'x', 'description': 'd', 'done': 1}):
+            response = self.client.post(API + '/batch', json={'operations': [operation]})
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual([(task['title'], task['done']) for task in self.security.storage.get_tasks()], [('one', False)])
+
+
+class RecordingLimiter(object):
+    def __init__(self):
+        self.keys = []
+
+    def acquire(self, key):
+        self.keys.append(key)
+        return 0
+
+
+class RateLimitKeyTest(unittest.TestCase):
+    """
+    Requests are rate limited per user: by 'oid', or 'sub' for tokens without one
+    """
+    def setUp(self):
+        self.security = securityImpl.securityImpl()
+        self.security.rateLimiter = RecordingLimiter()
+        self.security.concurrencyLimiter = None
+        self.security.validateClaims = lambda bearerToken, decodedToken: (True, None)
+
+    def validate(self, decodedToken):
+        self.security.jwtValidator.validate_request = lambda request: (True, 'token', decodedToken)
+        return self.security.validateRequest(None)
+
+    def test_oid(self):
+        self.assertTrue(self.validate({'oid': 'o1', 'sub': 's1'})[0])
+        self.assertEqual(self.security.rateLimiter.keys, ['o1'])
+
+    def test_sub(self):
+        self.assertTrue(self.validate({'sub': 's1'})[0])
+        self.assertEqual(self.security.rateLimiter.keys, ['s1'])
+
+    def test_no_user(self):
+        bRV, response = self.validate({'aud': 'api://test-service'})
+        self.assertFalse(bRV)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.security.rateLimiter.keys, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
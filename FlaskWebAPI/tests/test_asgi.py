@@ -0,0 +1,64 @@
+import asyncio
+import os
+import time
+import unittest
+
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+import admissionControl
+import app
+import asgiApp
+import securityImpl
+from localBlobService import MemoryBlobService
+
+API = '/todo/api/v1.0/tasks'
+
+
+class AdmissionTest(unittest.TestCase):
+    """
+    Requests waiting for an admission slot must not hold up the streamed responses of the
+    admitted ones, even with fewer I/O threads than queued requests
+    """
+    def setUp(self):
+        self.securityObj, self.threshold = app.securityObj, app.RESPONSE_STREAM_THRESHOLD
+        self.security = securityImpl.securityImpl()
+        self.security.rateLimiter = None
+        self.security.concurrencyLimiter = admissionControl.ConcurrencyLimiter(2, 8, 2.0)
+        self.security.validateClaims = lambda bearerToken, decodedToken: (True, None)
+        self.security.jwtValidator.validate_request = lambda request: (True, 'token', {'oid': 'o1'})
+        storage = self.security.get_StorageObject()
+        storage.service = storage.append_service = MemoryBlobService()
+        for i in range(20):
+            storage.create_task('task {0}'.format(i), '')
+        app.securityObj = self.security
+        app.RESPONSE_STREAM_THRESHOLD = 0
+        self.asgi = asgiApp.TaskApiAsgi(app.wsgi_app, io_threads=4)
+
+    def tearDown(self):
+        app.securityObj, app.RESPONSE_STREAM_THRESHOLD = self.securityObj, self.threshold
+        self.asgi.shutdown()
+
+    async def get(self, path):
+        messages = []
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        async def send(message):
+            messages.append(message)
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': []}
+        await self.asgi(scope, receive, send)
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return messages[0]['status'], body
+
+    def test_streamed_with_queue(self):
+        async def requests():
+            return await asyncio.gather(*[self.get(API) for _ in range(8)])
+        start = time.monotonic()
+        results = asyncio.run(requests())
+        self.assertEqual([status for status, body in results], [200] * 8)
+        self.assertTrue(all(b'"task 19"' in body for status, body in results))
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(self.security.concurrencyLimiter.get_stats()['active'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
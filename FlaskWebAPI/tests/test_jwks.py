@@ -0,0 +1,138 @@
+import base64
+import json
+import os
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import validateJWT
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DISCOVERY_PATH = '/tenant/.well-known/openid-configuration'
+KEYS_PATH = '/common/discovery/keys'
+
+
+def load_bundled(file_name):
+    """
+    first JSON document of one of the bundled captures, which start with the URL they came from
+    """
+    with open(os.path.join(HERE, file_name)) as f:
+        text = f.read()
+    return json.JSONDecoder().raw_decode(text, text.index('{'))[0]
+
+
+class StubIdentityProvider(object):
+    """
+    Serves openid-conf.json and discovery-keys.json on localhost, with jwks_uri pointing 
+    back at it, and counts the requests per path. While down, both paths answer 404.
+    """
+    def __init__(self):
+        self.configuration = load_bundled('openid-conf.json')
+        self.keys = load_bundled('discovery-keys.json')
+        self.down = False
+        self.requests = {}
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests[self.path] = stub.requests.get(self.path, 0) + 1
+                documents = {DISCOVERY_PATH: stub.configuration, KEYS_PATH: stub.keys}
+                if (stub.down or self.path not in documents):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = json.dumps(documents[self.path]).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.configuration['jwks_uri'] = self.url + KEYS_PATH
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class JwksCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubIdentityProvider()
+        self.jwks = validateJWT.JwksCache(self.stub.url + DISCOVERY_PATH)
+
+    def tearDown(self):
+        self.jwks.stop()
+        self.stub.stop()
+
+    def test_bundled_keys(self):
+        for jwk in self.stub.keys['keys']:
+            key = self.jwks.get_key(jwk['kid'])
+            self.assertEqual(key.public_numbers().n, validateJWT.decode_value(jwk['n']))
+        self.assertEqual(self.jwks.issuer, self.stub.configuration['issuer'])
+        # one fetch for all of them
+        self.assertEqual(self.stub.requests, {DISCOVERY_PATH: 1, KEYS_PATH: 1})
+
+    def test_unknown_kid_refetches_once_per_interval(self):
+        for i in range(5):
+            with self.assertRaises(validateJWT.InvalidAuthorizationToken):
+                self.jwks.get_key('unknown-kid')
+        self.assertEqual(self.stub.requests[KEYS_PATH], 1)
+        self.jwks._last_fetch -= self.jwks.min_refetch_seconds
+        with self.assertRaises(validateJWT.InvalidAuthorizationToken):
+            self.jwks.get_key('unknown-kid')
+        self.assertEqual(self.stub.requests[KEYS_PATH], 2)
+
+    def test_outage_is_not_fetched_on_every_request(self):
+        self.stub.down = True
+        kid = self.stub.keys['keys'][0]['kid']
+        with self.assertRaises(Exception):
+            self.jwks.get_key(kid)
+        # no keys at all, still only one fetch per min_retry_seconds
+        for i in range(5):
+            with self.assertRaises(validateJWT.InvalidAuthorizationToken):
+                self.jwks.get_key(kid)
+        self.assertEqual(self.stub.requests, {DISCOVERY_PATH: 1})
+        self.stub.down = False
+        self.jwks._last_fetch -= self.jwks.min_retry_seconds
+        self.assertIsNotNone(self.jwks.get_key(kid))
+        self.assertEqual(self.stub.requests, {DISCOVERY_PATH: 2, KEYS_PATH: 1})
+
+    def test_validates_a_token_signed_with_a_published_key(self):
+        import appSecrets
+        import jwt
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        signing_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        numbers = signing_key.public_key().public_numbers()
+        self.stub.keys['keys'].append({'kty': 'RSA', 'use': 'sig', 'kid': 'test-key',
+                                       'n': encode_value(numbers.n), 'e': encode_value(numbers.e)})
+        now = int(time.time())
+        claims = {'aud': appSecrets.ClientId, 'iss': self.stub.configuration['issuer'], 
+                  'iat': now, 'nbf': now, 'exp': now + 300, 'oid': 'test-user'}
+        token = jwt.encode(claims, signing_key, algorithm='RS256', headers={'kid': 'test-key'})
+
+        validator = validateJWT.validateJWT()
+        validator.jwks = self.jwks
+        self.assertEqual(validator.validate_jwt(token), (True, claims))
+        # verified tokens are cached, the keys are fetched once
+        self.assertEqual(validator.validate_jwt(token), (True, claims))
+        self.assertEqual(self.stub.requests, {DISCOVERY_PATH: 1, KEYS_PATH: 1})
+        with self.assertRaises(jwt.InvalidAudienceError):
+            validator.validate_jwt(jwt.encode(dict(claims, aud='someone-else'), signing_key, 
+                                              algorithm='RS256', headers={'kid': 'test-key'}))
+
+
+def encode_value(value):
+    return base64.urlsafe_b64encode(value.to_bytes((value.bit_length() + 7) // 8, 'big')).rstrip(b'=').decode('ascii')
+
+
+if __name__ == '__main__':
+    unittest.main()
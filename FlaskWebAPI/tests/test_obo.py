@@ -0,0 +1,155 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpTransport
+import securityImpl
+
+CONCURRENT_REQUESTS = 20
+TOKEN_PATH = '/tenant/oauth2/token'
+
+
+class StubTokenEndpoint(object):
+    """
+    Answers on-behalf-of token requests on localhost after delay seconds, counting them 
+    per assertion. status and body can be changed to make it fail.
+    """
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.status = 200
+        self.body = None        # None: a token for the assertion
+        self.expires_in = 3600
+        self.calls = {}
+        self.calls_lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                from urllib.parse import parse_qs
+                length = int(self.headers['Content-Length'])
+                assertion = parse_qs(self.rfile.read(length).decode('utf-8'))['assertion'][0]
+                with stub.calls_lock:
+                    stub.calls[assertion] = stub.calls.get(assertion, 0) + 1
+                time.sleep(stub.delay)
+                body = stub.body
+                if (body is None):
+                    body = json.dumps({'token_type': 'Bearer', 'expires_in': stub.expires_in,
+                                       'access_token': 'obo-' + assertion})
+                body = body.encode('utf-8')
+                self.send_response(stub.status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}{1}'.format(self.server.server_port, TOKEN_PATH)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return
+
+    def exchange(self, assertion):
+        """
+        the token request of securityImpl.exchangeUserCredentials, made to the stub
+        """
+        r = httpTransport.post(self.url, data={'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
+                                               'requested_token_use': 'on_behalf_of',
+                                               'assertion': assertion})
+        if (r.status_code >= 200 and r.status_code < 300):
+            return json.loads(r.text), None
+        return None, r
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class OboTokenCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubTokenEndpoint()
+        self.cache = securityImpl.OboTokenCache(100, refresh_ahead=60)
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def get_concurrently(self, keys):
+        """
+        get_token from one thread per key, all at once. Returns (key, result or exception) pairs.
+        """
+        results = []
+        start = threading.Barrier(len(keys))
+        def get(key):
+            start.wait()
+            try:
+                results.append((key, self.cache.get_token(key, lambda: self.stub.exchange(key))))
+            except Exception as ex:
+                results.append((key, ex))
+        threads = [threading.Thread(target=get, args=(key,)) for key in keys]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_requests_share_one_exchange(self):
+        results = self.get_concurrently(['user-1'] * CONCURRENT_REQUESTS)
+        self.assertEqual(len(results), CONCURRENT_REQUESTS)
+        for key, (access_token, response) in results:
+            self.assertEqual(access_token['access_token'], 'obo-user-1')
+            self.assertIsNone(response)
+        self.assertEqual(self.stub.calls, {'user-1': 1})
+        # and later ones come from the cache
+        self.cache.get_token('user-1', lambda: self.stub.exchange('user-1'))
+        self.assertEqual(self.stub.calls, {'user-1': 1})
+        self.assertEqual(self.cache.get_stats()['external_calls'], 1)
+
+    def test_one_exchange_per_key(self):
+        keys = ['user-{0}'.format(i % 4) for i in range(CONCURRENT_REQUESTS)]
+        for key, (access_token, response) in self.get_concurrently(keys):
+            self.assertEqual(access_token['access_token'], 'obo-' + key)
+        self.assertEqual(self.stub.calls, {'user-0': 1, 'user-1': 1, 'user-2': 1, 'user-3': 1})
+        self.assertEqual(self.cache.get_stats()['external_calls'], 4)
+
+    def test_error_response_goes_to_every_waiting_request(self):
+        self.stub.status = 400
+        self.stub.body = '{"error": "invalid_grant"}'
+        for key, (access_token, response) in self.get_concurrently(['user-1'] * CONCURRENT_REQUESTS):
+            self.assertIsNone(access_token)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stub.calls, {'user-1': 1})
+        # errors are not cached
+        self.stub.status = 200
+        self.stub.body = None
+        access_token, response = self.cache.get_token('user-1', lambda: self.stub.exchange('user-1'))
+        self.assertEqual(access_token['access_token'], 'obo-user-1')
+        self.assertEqual(self.stub.calls, {'user-1': 2})
+
+    def test_exception_is_raised_in_every_waiting_request(self):
+        self.stub.body = 'not json'
+        results = self.get_concurrently(['user-1'] * CONCURRENT_REQUESTS)
+        self.assertEqual(len(results), CONCURRENT_REQUESTS)
+        for key, result in results:
+            self.assertIsInstance(result, ValueError)
+        self.assertEqual(self.stub.calls, {'user-1': 1})
+        self.assertEqual(self.cache._inflight, {})
+
+    def test_token_near_expiry_is_refreshed_in_the_background(self):
+        self.stub.expires_in = 30       # within refresh_ahead
+        first, response = self.cache.get_token('user-1', lambda: self.stub.exchange('user-1'))
+        self.stub.expires_in = 3600
+        # served at once while the refresh runs
+        served, response = self.cache.get_token('user-1', lambda: self.stub.exchange('user-1'))
+        self.assertEqual(served['expires_in'], 30)
+        deadline = time.time() + 5
+        while (self.cache._tokens.get('user-1')[0]['expires_in'] == 30 and time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(self.cache._tokens.get('user-1')[0]['expires_in'], 3600)
+        self.assertEqual(self.stub.calls, {'user-1': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
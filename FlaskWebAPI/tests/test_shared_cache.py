@@ -0,0 +1,55 @@
+import os
+import stat
+import tempfile
+import time
+import unittest
+
+import sharedCache
+
+
+class SharedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix='taskapi-test-')
+        self.path = os.path.join(self.directory.name, 'shared.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_set_get_expire(self):
+        cache = sharedCache.SharedCache(self.path)
+        cache.set('a', {'value': [1, 2]}, time.time() + 60)
+        cache.set('b', 'gone', time.time() - 1)
+        # a second cache on the same file, as in another worker process
+        other = sharedCache.SharedCache(self.path)
+        self.assertEqual(other.get('a'), {'value': [1, 2]})
+        self.assertIsNone(other.get('b'))
+        self.assertIsNone(other.get('c'))
+
+    def test_damaged_entry_is_removed(self):
+        cache = sharedCache.SharedCache(self.path)
+        cache.set('a', 'good', time.time() + 60)
+        connection = cache._connection()
+        with connection:
+            connection.execute("UPDATE entries SET value = '{not json' WHERE key = 'a'")
+        with self.assertLogs('sharedCache', 'WARNING'):
+            self.assertIsNone(cache.get('a'))
+        self.assertIsNone(connection.execute("SELECT value FROM entries WHERE key = 'a'").fetchone())
+        cache.set('a', 'good again', time.time() + 60)
+        self.assertEqual(cache.get('a'), 'good again')
+
+    @unittest.skipIf(os.name == 'nt', 'POSIX permissions')
+    def test_files_are_private(self):
+        # a file that was there already, readable by everyone
+        os.close(os.open(self.path, os.O_CREAT | os.O_WRONLY, 0o644))
+        os.chmod(self.path, 0o644)
+        cache = sharedCache.SharedCache(self.path)
+        cache.set('storage_key', 'secret', time.time() + 60)
+        files = [name for name in os.listdir(self.directory.name) if name.startswith('shared.db')]
+        self.assertIn('shared.db-wal', files)
+        for name in files:
+            mode = stat.S_IMODE(os.stat(os.path.join(self.directory.name, name)).st_mode)
+            self.assertEqual(mode, 0o600, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
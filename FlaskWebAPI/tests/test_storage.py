@@ -0,0 +1,373 @@
+import random
+import sys
+import threading
+import unittest
+from collections import OrderedDict
+
+import jsonCodec
+import storageBlobService
+from localBlobService import MemoryBlobService
+
+STRESS_THREADS = 8
+STRESS_OPERATIONS = 40      # per thread
+
+
+class ConcurrentMutationsTest(unittest.TestCase):
+    """
+    Several writers, each with its own StorageBlobServiceWrapper (and so its own cache, like
+    separate worker processes), share one blob store. Every mutation that returned without
+    an error has to be in the final task list, and nothing else.
+    """
+    def setUp(self):
+        # switch threads far more often than usual, so the writers really interleave
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def test_single(self):
+        self.run_writers(storageBlobService.LAYOUT_SINGLE)
+
+    def test_single_coalesced(self):
+        self.run_writers(storageBlobService.LAYOUT_SINGLE, coalesce_window_seconds=0.002)
+
+    def test_log(self):
+        self.run_writers(storageBlobService.LAYOUT_LOG)
+
+    def test_log_coalesced_and_compacted(self):
+        self.run_writers(storageBlobService.LAYOUT_LOG, coalesce_window_seconds=0.002, log_compact_bytes=4096)
+
+    def test_sharded(self):
+        self.run_writers(storageBlobService.LAYOUT_SHARDED)
+
+    def run_writers(self, layout, coalesce_window_seconds=0, log_compact_bytes=None):
+        service = MemoryBlobService()
+        acknowledged = []       # per thread: {id: title} of the tasks it created, None once it deleted them
+        errors = []
+
+        def writer(number):
+            storage = self.open_storage(service, layout, coalesce_window_seconds, log_compact_bytes)
+            tasks = {}
+            acknowledged.append(tasks)
+            rng = random.Random(number)
+            for i in range(STRESS_OPERATIONS):
+                live = [task_id for task_id, title in tasks.items() if title is not None]
+                choice = rng.random()
+                try:
+                    if (len(live) == 0 or choice < 0.5):
+                        title = 'w{0}-create-{1}'.format(number, i)
+                        task = storage.create_task(title, '')
+                        self.assertIsNone(tasks.get(task['id']))
+                        tasks[task['id']] = title
+                    elif (choice < 0.8):
+                        task_id = rng.choice(live)
+                        title = 'w{0}-update-{1}'.format(number, i)
+                        self.assertIsNotNone(storage.update_task(task_id, title, '', True))
+                        tasks[task_id] = title
+                    else:
+                        task_id = rng.choice(live)
+                        self.assertTrue(storage.delete_task(task_id))
+                        tasks[task_id] = None
+                except storageBlobService.WriteConflictError:
+                    # not acknowledged, so it must not have been applied either
+                    pass
+                except Exception as ex:
+                    errors.append(ex)
+                    return
+
+        threads = [threading.Thread(target=writer, args=(number,)) for number in range(STRESS_THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        final = self.open_storage(service, layout).get_tasks()
+        ids = [task['id'] for task in final]
+        self.assertEqual(len(ids), len(set(ids)), 'duplicate task ids')
+        titles = {task['id']: task['title'] for task in final}
+        expected = {}
+        for tasks in acknowledged:
+            for task_id, title in tasks.items():
+                if (title is not None):
+                    # the id of a deleted task can be given out again, but never to two live tasks
+                    self.assertIsNone(expected.get(task_id), 'task {0} created twice'.format(task_id))
+                    expected[task_id] = title
+        self.assertEqual(titles, expected)
+
+    def open_storage(self, service, layout, coalesce_window_seconds=0, log_compact_bytes=None):
+        storage = storageBlobService.StorageBlobServiceWrapper('test', layout=layout,
+                                                               coalesce_window_seconds=coalesce_window_seconds)
+        storage.service = storage.append_service = service
+        if (log_compact_bytes is not None):
+            storage.log_compact_bytes = log_compact_bytes
+        return storage
+
+
+class SharedCacheMutationsTest(unittest.TestCase):
+    """
+    Writers and readers share one StorageBlobServiceWrapper, and so its cached tasks, which 
+    the log layout changes in place. A client following the change feed ends up with the 
+    final list.
+    """
+    def setUp(self):
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def test_single(self):
+        self.run_shared(storageBlobService.LAYOUT_SINGLE)
+
+    def test_log(self):
+        self.run_shared(storageBlobService.LAYOUT_LOG)
+
+    def run_shared(self, layout):
+        service = MemoryBlobService()
+        storage = ConcurrentMutationsTest.open_storage(self, service, layout)
+        # long enough for listing it to overlap with writes
+        storage.update_blob_tasks([{'id': task_id, 'title': 'seed', 'description': '', 'done': False} 
+                                   for task_id in range(1, 2001)])
+        errors = []
+        stop = threading.Event()
+
+        def writer(number):
+            rng = random.Random(number)
+            live = []
+            try:
+                for i in range(STRESS_OPERATIONS):
+                    if (len(live) == 0 or rng.random() < 0.5):
+                        live.append(storage.create_task('w{0}-{1}'.format(number, i), '')['id'])
+                    elif (rng.random() < 0.6):
+                        storage.update_task(rng.choice(live), 'w{0}-{1}'.format(number, i), '', rng.random() < 0.5)
+                    else:
+                        task_id = rng.choice(live)
+                        live.remove(task_id)
+                        storage.delete_task(task_id)
+            except storageBlobService.WriteConflictError:
+                pass
+            except Exception as ex:
+                errors.append(ex)
+
+        def reader():
+            try:
+                while (not stop.is_set()):
+                    ids = [task['id'] for task in storage.get_tasks()]
+                    self.assertEqual(len(ids), len(set(ids)))
+                    storage.get_tasks_page(0, 10, True)
+            except Exception as ex:
+                errors.append(ex)
+
+        feed = {}
+        def poll(since):
+            rev, changed, deleted, reset = storage.get_changes(since)
+            if (reset):
+                feed.clear()
+            for task in changed:
+                feed[task['id']] = task['title']
+            for task_id in deleted:
+                feed.pop(task_id, None)
+            return rev
+
+        def poller():
+            since = 0
+            try:
+                while (not stop.is_set()):
+                    since = poll(since)
+            except Exception as ex:
+                errors.append(ex)
+            feed['since'] = since
+
+        writers = [threading.Thread(target=writer, args=(number,)) for number in range(STRESS_THREADS)]
+        others = [threading.Thread(target=reader), threading.Thread(target=poller)]
+        for thread in writers + others:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        stop.set()
+        for thread in others:
+            thread.join()
+        self.assertEqual(errors, [])
+        poll(feed.pop('since'))
+        final = {task['id']: task['title'] for task in ConcurrentMutationsTest.open_storage(self, service, layout).get_tasks()}
+        self.assertEqual({task['id']: task['title'] for task in storage.get_tasks()}, final)
+        self.assertEqual(feed, final)
+
+
+class TaskChangesTest(unittest.TestCase):
+    """
+    TaskChanges reads like the table with its changes applied, without copying the table
+    """
+    def test_against_a_copy(self):
+        rng = random.Random(7)
+        for run in range(50):
+            table = storageBlobService.TaskTable((task_id, {'id': task_id, 'title': 'old', 'rev': 1}) 
+                                                 for task_id in range(1, rng.randint(0, 8)))
+            table.rev = 1
+            before = list(table.items())
+            changes = table.next_version()
+            expected = OrderedDict(table)
+            for i in range(rng.randint(1, 12)):
+                task_id = rng.randint(1, 10)
+                if (task_id in expected and rng.random() < 0.5):
+                    changes.remove(task_id)
+                    del expected[task_id]
+                else:
+                    task = {'id': task_id, 'title': 'new {0}'.format(i)}
+                    changes.put(task)
+                    expected[task_id] = task
+                self.assertEqual(list(reversed(changes)), list(reversed(expected)))
+                self.assertEqual(len(changes), len(expected))
+                for task_id in range(1, 11):
+                    self.assertEqual(task_id in changes, task_id in expected)
+                    self.assertEqual(changes.get(task_id), expected.get(task_id))
+            self.assertEqual(list(changes.table().items()), list(expected.items()))
+            self.assertEqual(changes.table().rev, 2)
+            self.assertEqual(list(table.items()), before)
+
+
+class ReplaceTaskListTest(unittest.TestCase):
+    """
+    update_blob_tasks replaces the whole list; in the log layout it starts a new log generation
+    """
+    def setUp(self):
+        self.service = MemoryBlobService()
+
+    def open_storage(self, layout):
+        return ConcurrentMutationsTest.open_storage(self, self.service, layout)
+
+    def test_single(self):
+        self.check_replace(storageBlobService.LAYOUT_SINGLE)
+
+    def test_log(self):
+        self.check_replace(storageBlobService.LAYOUT_LOG)
+
+    def check_replace(self, layout):
+        storage = self.open_storage(layout)
+        for i in range(3):
+            storage.create_task('old {0}'.format(i), '')
+        rev = storage.get_list_version()[0]
+        storage.update_blob_tasks([{'id': 7, 'title': 'seven', 'description': '', 'done': False}])
+        # the writes that follow go on from the replaced list, in this process and others
+        self.assertEqual(storage.create_task('eight', '')['id'], 8)
+        self.assertTrue(storage.update_task(7, 'Seven', '', True))
+        for reader in (storage, self.open_storage(layout)):
+            self.assertEqual([(task['id'], task['title']) for task in reader.get_tasks()], [(7, 'Seven'), (8, 'eight')])
+            self.assertGreater(reader.get_list_version()[0], rev)
+
+    def test_log_if_match(self):
+        storage = self.open_storage(storageBlobService.LAYOUT_LOG)
+        storage.create_task('one', '')
+        etag = storage.get_list_version()[1]
+        self.open_storage(storageBlobService.LAYOUT_LOG).create_task('two', '')
+        with self.assertRaises(storageBlobService.WriteConflictError):
+            storage.update_blob_tasks([], if_match=etag)
+        storage.update_blob_tasks([], if_match=self.open_storage(storageBlobService.LAYOUT_LOG).get_list_version()[1])
+        self.assertEqual(self.open_storage(storageBlobService.LAYOUT_LOG).get_tasks(), [])
+
+    def test_log_compaction_after_replace(self):
+        storage = self.open_storage(storageBlobService.LAYOUT_LOG)
+        storage.update_blob_tasks([{'id': 1, 'title': 'one', 'description': '', 'done': False}])
+        storage.create_task('two', '')
+        self.assertTrue(storage.compact_log())
+        storage.create_task('three', '')
+        self.assertEqual([task['title'] for task in self.open_storage(storageBlobService.LAYOUT_LOG).get_tasks()], 
+                         ['one', 'two', 'three'])
+
+
+class SchemaMismatchTest(unittest.TestCase):
+    """
+    With the msgspec codec, a list whose records do not match the task schema is still read
+    """
+    def setUp(self):
+        self.backend = (jsonCodec.BACKEND, jsonCodec._orjson, jsonCodec._msgspec, jsonCodec._TaskBlob)
+        jsonCodec._orjson = None
+        if (jsonCodec._load_backend('msgspec') != 'msgspec'):
+            self.skipTest('msgspec is not installed')
+
+    def tearDown(self):
+        jsonCodec.BACKEND, jsonCodec._orjson, jsonCodec._msgspec, jsonCodec._TaskBlob = self.backend
+
+    def test_read_and_write(self):
+        service = MemoryBlobService()
+        storage = ConcurrentMutationsTest.open_storage(self, service, storageBlobService.LAYOUT_SINGLE)
+        storage.create_task('one', '')
+        service.create_blob_from_text(storage.container_name, storage.blob_name, 
+                                      '[{"id": 1, "title": "one", "description": "", "done": "yes"}]')
+        storage = ConcurrentMutationsTest.open_storage(self, service, storageBlobService.LAYOUT_SINGLE)
+        self.assertEqual(storage.get_task(1)['done'], 'yes')
+        self.assertEqual(storage.update_task(1, 'one', '', True)['done'], True)
+        self.assertEqual(storage.create_task('two', '')['id'], 2)
+
+
+class ShardedLayoutTest(unittest.TestCase):
+    def setUp(self):
+        self.service = MemoryBlobService()
+        self.storage = ConcurrentMutationsTest.open_storage(self, self.service, storageBlobService.LAYOUT_SHARDED)
+        for title in ('one', 'two'):
+            self.storage.create_task(title, '')
+
+    def test_no_task_list_blob(self):
+        for call in (self.storage.get_blob_tasks, self.storage.get_list_version, lambda: self.storage.get_changes(0), 
+                     lambda: self.storage.update_blob_tasks([])):
+            with self.assertRaises(ValueError):
+                call()
+        self.assertEqual([task['title'] for task in self.storage.get_tasks()], ['one', 'two'])
+
+    def test_interrupted_delete(self):
+        put_index = self.storage._put_index
+        def fail(index, **kwargs):
+            raise RuntimeError('interrupted')
+        self.storage._put_index = fail
+        with self.assertRaises(RuntimeError):
+            self.storage.delete_task(1)
+        self.storage._put_index = put_index
+        # the id is still in the index, but the task is gone for every call
+        self.assertIsNone(self.storage.get_task(1))
+        self.assertIsNone(self.storage.update_task(1, 'one', '', True))
+        self.assertEqual([task['id'] for task in self.storage.get_tasks()], [2])
+        self.assertFalse(self.storage.delete_task(1))
+        self.assertEqual(self.storage._get_index()[0]['ids'], [2])
+
+
+class StaleExistsService(object):
+    """
+    Reports every blob as missing, like an exists() check made just before another process
+    created it
+    """
+    def __init__(self, service):
+        self.service = service
+
+    def exists(self, container_name, blob_name=None):
+        return (blob_name is None) and self.service.exists(container_name)
+
+    def __getattr__(self, name):
+        return getattr(self.service, name)
+
+
+class FirstStartTest(unittest.TestCase):
+    """
+    A process starting while another one creates and writes the list must not write over it
+    """
+    def test_single(self):
+        self.check_first_start(storageBlobService.LAYOUT_SINGLE)
+
+    def test_log(self):
+        self.check_first_start(storageBlobService.LAYOUT_LOG)
+
+    def test_sharded(self):
+        self.check_first_start(storageBlobService.LAYOUT_SHARDED)
+
+    def check_first_start(self, layout):
+        service = MemoryBlobService()
+        ConcurrentMutationsTest.open_storage(self, service, layout).create_task('one', '')
+        late = ConcurrentMutationsTest.open_storage(self, StaleExistsService(service), layout)
+        late.create_task('two', '')
+        tasks = ConcurrentMutationsTest.open_storage(self, service, layout).get_tasks()
+        self.assertEqual([(task['id'], task['title']) for task in tasks], [(1, 'one'), (2, 'two')])
+
+
+if __name__ == '__main__':
+    unittest.main()
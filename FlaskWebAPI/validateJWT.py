@@ -1,14 +1,27 @@
 import base64
-from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicNumbers
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
-import jwt
+import hashlib
 import json
+import logging
+import threading
+import time
 import appSecrets
+import httpTransport
+import metrics
+import sharedCache
+from expiringCache import ExpiringLRUCache
+# jwt and cryptography are imported where they are used, see prewarm 
 # Code sample inspired from 
 # https://robertoprevato.github.io/Validating-JWT-Bearer-tokens-from-Azure-AD-in-Python/ 
 # https://github.com/Azure-Samples/active-directory-dotnet-webapi-manual-jwt-validation/blob/master/TodoListService-ManualJwt/Global.asax.cs 
 
+JWKS_REFRESH_SECONDS = 6 * 60 * 60   # background refresh of the signing keys, 6 hours
+JWKS_MIN_REFETCH_SECONDS = 60       # at most one refetch per minute for an unknown 'kid'
+JWKS_MIN_RETRY_SECONDS = 5          # while we have no keys at all, at most one fetch per 5 seconds
+MX_VERIFIED_TOKENS = 4096           # verified tokens kept, with their claims, until they expire
+SHARED_JWKS_KEY = 'jwks'            # entry of the signing keys in the shared cache
+
+log = logging.getLogger(__name__)
+
 
 class validateJWT(object):
     """
@@ -20,11 +33,22 @@ class validateJWT(object):
         self.valid_audiences = [appSecrets.ClientId,appSecrets.serviceIdentifierUri]
         self.Instance = appSecrets.InstanceName
         self.TenantId = appSecrets.TenantId
-        self.Public_Key = None
-        self.Issuer = None
+        stsDiscoveryEndpoint = '{0}{1}/.well-known/openid-configuration'.format(self.Instance, self.TenantId)
+        self.jwks = JwksCache(stsDiscoveryEndpoint, shared_cache=sharedCache.get_shared_cache())
+        # tokens that passed verification, keyed by their hash, so a caller reusing the 
+        # same bearer token is not verified again until the token expires
+        self.verifiedTokens = ExpiringLRUCache(MX_VERIFIED_TOKENS)
         
         return 
 
+    def prewarm(self):
+        """
+        Fetches the signing keys now and keeps refreshing them in the background, so no 
+        request has to wait for them
+        """
+        import jwt
+        self.jwks.start()
+
     def validate_request(self, request):
         bRV = False
         bearerToken = None
@@ -34,37 +58,28 @@ class validateJWT(object):
         if (authorization_header is not None):
             bearerToken = authorization_header.split('Bearer ')[1]
             if (bearerToken is not None):
-                bRV, decodedToken = self.validate_jwt(bearerToken)
+                with metrics.span('token_verify'):
+                    bRV, decodedToken = self.validate_jwt(bearerToken)
         return bRV, bearerToken, decodedToken
 
     def validate_jwt(self, jwt_to_validate):
         bRV = False
 
-        if (self.Public_Key == None or self.Issuer == None):
-            print('Getting public key for the first time... ')
-            #if __debug__:
-            #    import webbrowser
-            #    url = 'https://jwt.ms/#id_token=' + jwt_to_validate
-            #    webbrowser.open(url, new=0, autoraise=True)
-
-            stsDiscoveryEndpoint = '{0}{1}/.well-known/openid-configuration'.format(self.Instance, self.TenantId)
-            import requests
-            
-            r = requests.get(stsDiscoveryEndpoint)
-            jsonData = r.json()
-            self.Issuer = jsonData['issuer']
-            jwks_uri = jsonData['jwks_uri']
-            if (jwks_uri):
-                r = requests.get(jwks_uri)
-                jWks = r.json()
-                self.Public_Key = self.get_public_key(jwt_to_validate, jWks)
+        tokenHash = hashlib.sha256(self.ensure_bytes(jwt_to_validate)).hexdigest()
+        decoded = self.verifiedTokens.get(tokenHash)
+        if (decoded is not None):
+            return True, decoded
 
+        import jwt
+        public_key = self.jwks.get_key(self.get_kid(jwt_to_validate))
         decoded = jwt.decode(   jwt_to_validate,
-                                self.Public_Key,
+                                public_key,
                                 verify=True,
                                 algorithms=['RS256'],
                                 audience=self.valid_audiences,
-                                issuer=self.Issuer)
+                                issuer=self.jwks.issuer)
+        if ('exp' in decoded):
+            self.verifiedTokens.set(tokenHash, decoded, decoded['exp'])
         bRV = True
         return bRV, decoded
 
@@ -75,6 +90,7 @@ class validateJWT(object):
         """
         extracts the 'kid' key from the header of the extracted token. 
         """
+        import jwt
         headers = jwt.get_unverified_header(token)
         if not headers:
             raise InvalidAuthorizationToken('missing headers')
@@ -90,24 +106,144 @@ class validateJWT(object):
         raise InvalidAuthorizationToken('kid not recognized')
 
     def rsa_pem_from_jwk(self, jwk):
-        return RSAPublicNumbers(
-            n=self.decode_value(jwk['n']),
-            e=self.decode_value(jwk['e'])
-        ).public_key(default_backend()).public_bytes(
+        from cryptography.hazmat.primitives import serialization
+        return rsa_public_key_from_jwk(jwk).public_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PublicFormat.SubjectPublicKeyInfo
         )
 
     def decode_value(self, val):
-        decoded = base64.urlsafe_b64decode(self.ensure_bytes(val) + b'==')
-        return int.from_bytes(decoded, 'big')
+        return decode_value(val)
 
     def ensure_bytes(self, key):
-        if isinstance(key, str):
-            key = key.encode('utf-8')
-        return key
+        return ensure_bytes(key)
  
 
+class JwksCache(object):
+    """
+    Holds every signing key published for the tenant, by 'kid', as ready to use public key
+    objects. The keys are refreshed in the background every refresh_seconds; a token 
+    signed with a key we do not know triggers a refetch, at most once per min_refetch_seconds, 
+    or once per min_retry_seconds while we have no keys (the identity provider was down), 
+    so a burst of requests never turns into a burst of fetches. With a shared_cache, keys fetched by another worker process are used instead of 
+    fetching them again.
+    """
+    def __init__(self, discovery_endpoint, refresh_seconds=JWKS_REFRESH_SECONDS, 
+                 min_refetch_seconds=JWKS_MIN_REFETCH_SECONDS, min_retry_seconds=JWKS_MIN_RETRY_SECONDS, 
+                 shared_cache=None):
+        self.discovery_endpoint = discovery_endpoint
+        self.refresh_seconds = refresh_seconds
+        self.min_refetch_seconds = min_refetch_seconds
+        self.min_retry_seconds = min_retry_seconds
+        self.shared_cache = shared_cache
+        self.issuer = None
+        self._keys = {}
+        self._last_fetch = 0
+        self._fetched_at = 0        # when the keys we hold were fetched, by us or another worker
+        self._fetch_lock = threading.Lock()
+        self._timer = None
+        return
+
+    def start(self):
+        try:
+            self.refresh()
+        except Exception as ex:
+            # not fatal, the first request fetches the keys instead
+            log.warning('Pre-fetching signing keys failed: %s', ex)
+        self._schedule_refresh()
+
+    def stop(self):
+        if (self._timer is not None):
+            self._timer.cancel()
+
+    def refresh(self):
+        with self._fetch_lock:
+            if (not self._load_shared()):
+                self._fetch()
+
+    def get_key(self, kid):
+        key = self._keys.get(kid)
+        if (key is None):
+            with self._fetch_lock:
+                # another request may have fetched them while we waited
+                key = self._keys.get(kid)
+                if (key is None and self._load_shared()):
+                    key = self._keys.get(kid)
+                min_interval = self.min_refetch_seconds if (len(self._keys) > 0) else self.min_retry_seconds
+                if (key is None and (time.time() - self._last_fetch) >= min_interval):
+                    log.info('Signing key %s not known, fetching the keys', kid)
+                    self._fetch()
+                    key = self._keys.get(kid)
+            if (key is None):
+                raise InvalidAuthorizationToken('kid not recognized')
+        return key
+
+    def _fetch(self):
+        self._last_fetch = time.time()
+        r = httpTransport.get(self.discovery_endpoint)
+        jsonData = r.json()
+        issuer = jsonData['issuer']
+        r = httpTransport.get(jsonData['jwks_uri'])
+        jwks = [jwk for jwk in r.json().get('keys') if (jwk.get('kty') == 'RSA' and jwk.get('kid'))]
+        self._set_keys(issuer, jwks, self._last_fetch)
+        if (self.shared_cache is not None):
+            self.shared_cache.set(SHARED_JWKS_KEY, {'issuer': issuer, 'keys': jwks, 'fetched_at': self._last_fetch}, 
+                                  self._last_fetch + self.refresh_seconds)
+
+    def _load_shared(self):
+        """
+        Takes the keys from the shared cache when another worker fetched them after we 
+        got ours. Returns True if it did.
+        """
+        if (self.shared_cache is None):
+            return False
+        entry = self.shared_cache.get(SHARED_JWKS_KEY)
+        if (entry is None or entry['fetched_at'] <= self._fetched_at):
+            return False
+        self._set_keys(entry['issuer'], entry['keys'], entry['fetched_at'])
+        return True
+
+    def _set_keys(self, issuer, jwks, fetched_at):
+        keys = {}
+        for jwk in jwks:
+            keys[jwk['kid']] = rsa_public_key_from_jwk(jwk)
+        # replaced as a whole, readers never see a partial set
+        self.issuer = issuer
+        self._keys = keys
+        self._fetched_at = fetched_at
+
+    def _schedule_refresh(self):
+        self._timer = threading.Timer(self.refresh_seconds, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as ex:
+            log.warning('Refreshing signing keys failed: %s', ex)
+        finally:
+            self._schedule_refresh()
+
+
+def rsa_public_key_from_jwk(jwk):
+    from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicNumbers
+    from cryptography.hazmat.backends import default_backend
+    return RSAPublicNumbers(
+        n=decode_value(jwk['n']),
+        e=decode_value(jwk['e'])
+    ).public_key(default_backend())
+
+def decode_value(val):
+    decoded = base64.urlsafe_b64decode(ensure_bytes(val) + b'==')
+    return int.from_bytes(decoded, 'big')
+
+def ensure_bytes(key):
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return key
+
+
 class InvalidAuthorizationToken(Exception):
     def __init__(self, details):
         super().__init__('Invalid authorization token: ' + details)